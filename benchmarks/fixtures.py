@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import math
+from typing import List, Tuple
+
+import networkx
+
+from distance import Distance, meters_to_degrees
+from population import PopulationGeneratorConfig
+
+METERS_PER_LATITUDE_DEGREE = 111_320
+
+
+def _add_road(
+        graph: networkx.MultiDiGraph,
+        start: int,
+        end: int,
+        length: float,
+        speed_kph: float,
+        lanes: int,
+) -> None:
+    for (u, v) in ((start, end), (end, start)):
+        graph.add_edge(u, v, length=length, speed_kph=speed_kph, lanes=str(lanes))
+
+
+def _meters_between(graph: networkx.MultiDiGraph, start: int, end: int) -> float:
+    start_node, end_node = graph.nodes[start], graph.nodes[end]
+    dy = (start_node['y'] - end_node['y']) * METERS_PER_LATITUDE_DEGREE
+    dx = (start_node['x'] - end_node['x']) * METERS_PER_LATITUDE_DEGREE * math.cos(math.radians(start_node['y']))
+    return math.hypot(dx, dy)
+
+
+def grid_road_graph(
+        south: float,
+        west: float,
+        north: float,
+        east: float,
+        spacing: Distance = Distance(meters=250),
+        arterial_every: int = 5,
+) -> networkx.MultiDiGraph:
+    """Manhattan grid of two-way streets; every `arterial_every`-th row and column is a faster two lane road"""
+    latitude_step = spacing.meters / METERS_PER_LATITUDE_DEGREE
+    longitude_step = latitude_step / math.cos(math.radians((south + north) / 2))
+    rows = max(2, math.ceil((north - south) / latitude_step) + 1)
+    columns = max(2, math.ceil((east - west) / longitude_step) + 1)
+    graph = networkx.MultiDiGraph(crs="epsg:4326")
+
+    def node_id(row: int, column: int) -> int:
+        return row * columns + column + 1
+
+    for row in range(rows):
+        for column in range(columns):
+            graph.add_node(node_id(row, column), y=south + row * latitude_step, x=west + column * longitude_step)
+    for row in range(rows):
+        for column in range(columns):
+            for next_row, next_column in ((row, column + 1), (row + 1, column)):
+                if next_row >= rows or next_column >= columns:
+                    continue
+                arterial = row % arterial_every == 0 if next_row == row else column % arterial_every == 0
+                start, end = node_id(row, column), node_id(next_row, next_column)
+                _add_road(
+                    graph, start, end,
+                    length=_meters_between(graph, start, end),
+                    speed_kph=70 if arterial else 40,
+                    lanes=2 if arterial else 1,
+                )
+    return graph
+
+
+def radial_road_graph(
+        latitude: float,
+        longitude: float,
+        radius: Distance = Distance(kilometers=4),
+        rings: int = 12,
+        spokes: int = 24,
+) -> networkx.MultiDiGraph:
+    """Ring roads around a centre connected by spokes; spokes are faster than rings and the outermost ring"""
+    graph = networkx.MultiDiGraph(crs="epsg:4326")
+    centre_id = 0
+    graph.add_node(centre_id, y=latitude, x=longitude)
+
+    def node_id(ring: int, spoke: int) -> int:
+        return 1 + ring * spokes + spoke % spokes
+
+    for ring in range(rings):
+        ring_radius = meters_to_degrees(radius.meters * (ring + 1) / rings)
+        for spoke in range(spokes):
+            angle = 2 * math.pi * spoke / spokes
+            graph.add_node(
+                node_id(ring, spoke),
+                y=latitude + ring_radius * math.sin(angle),
+                x=longitude + ring_radius * math.cos(angle) / math.cos(math.radians(latitude)),
+            )
+    for spoke in range(spokes):
+        _add_road(graph, centre_id, node_id(0, spoke), _meters_between(graph, centre_id, node_id(0, spoke)), 60, 2)
+    for ring in range(rings):
+        outer = ring == rings - 1
+        for spoke in range(spokes):
+            start = node_id(ring, spoke)
+            _add_road(graph, start, node_id(ring, spoke + 1), _meters_between(graph, start, node_id(ring, spoke + 1)),
+                      speed_kph=90 if outer else 40, lanes=2 if outer else 1)
+            if ring + 1 < rings:
+                end = node_id(ring + 1, spoke)
+                _add_road(graph, start, end, _meters_between(graph, start, end), speed_kph=60, lanes=2)
+    return graph
+
+
+def config_bounds(config: PopulationGeneratorConfig, margin_radii: float = 4) -> Tuple[float, float, float, float]:
+    """(south, west, north, east) box covering every epicentre with `margin_radii` radii around it"""
+    boxes: List[Tuple[float, float, float, float]] = []
+    for epicentre in config.epicentres:
+        margin = epicentre.radius.degrees * margin_radii
+        longitude_margin = margin / math.cos(math.radians(epicentre.latitude))
+        boxes.append((
+            epicentre.latitude - margin,
+            epicentre.longitude - longitude_margin,
+            epicentre.latitude + margin,
+            epicentre.longitude + longitude_margin,
+        ))
+    south, west, north, east = zip(*boxes)
+    return min(south), min(west), max(north), max(east)
+
+
+def road_graph_for_config(config: PopulationGeneratorConfig, kind: str) -> networkx.MultiDiGraph:
+    south, west, north, east = config_bounds(config)
+    if kind == "grid":
+        return grid_road_graph(south, west, north, east)
+    if kind == "radial":
+        radius = Distance(meters=max(
+            (north - south) * METERS_PER_LATITUDE_DEGREE,
+            (east - west) * METERS_PER_LATITUDE_DEGREE * math.cos(math.radians((north + south) / 2)),
+        ) / 2)
+        return radial_road_graph((north + south) / 2, (east + west) / 2, radius=radius)
+    raise ValueError(f"Unknown road graph fixture kind: {kind}")
@@ -0,0 +1,146 @@
+"""
+Times every stage of the population -> clusters -> atlas -> assignment pipeline on synthetic road graphs.
+
+Usage: python -m benchmarks.run --scales 0.05 0.2 --resolutions 7 8 --output bench_report.json
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import datetime
+import json
+import pathlib
+import platform
+import time
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+from benchmarks.fixtures import road_graph_for_config
+from clusters import Cluster
+from my_types import ClusterCentreStrategy
+from pathing import get_atlas_path_data, get_paths_between_clusters
+from population import PopulationGeneratorConfig, child_seeds, generate_population
+from traffic import IncrementalBatchRouteAssigner
+from travel import TravelGenerator
+
+CONFIGS_DIRECTORY = pathlib.Path(__file__).resolve().parent.parent / "configs"
+
+_T = TypeVar("_T")
+
+
+def timed(timings: Dict[str, float], stage: str, function: Callable[[], _T]) -> _T:
+    started = time.perf_counter()
+    result = function()
+    timings[stage] = time.perf_counter() - started
+    return result
+
+
+def scaled_config(config: PopulationGeneratorConfig, scale: float) -> PopulationGeneratorConfig:
+    config = copy.deepcopy(config)
+    for epicentre in config.epicentres:
+        epicentre.population_count = max(1, round(epicentre.population_count * scale))
+    return config
+
+
+def run_scenario(
+        config_path: pathlib.Path,
+        scale: float,
+        resolution: int,
+        graph_kind: str,
+        batch_size: int,
+        iterations_count: int,
+        seed: int,
+) -> dict:
+    population_seed, travel_seed = child_seeds(seed, 2)
+    config = scaled_config(PopulationGeneratorConfig.from_json_file(config_path), scale)
+    road_graph = road_graph_for_config(config, graph_kind)
+    timings: Dict[str, float] = {}
+
+    points = timed(timings, "generate_data_points", lambda: generate_population(config, population_seed))
+    clusters = timed(timings, "clusterize_points", lambda: Cluster.clusterize_points(
+        points, resolution, ClusterCentreStrategy.HEXAGON_CENTER,
+    ))
+    clusters = timed(timings, "consolidate_clusters", lambda: Cluster.consolidate_clusters(
+        clusters, road_graph, resolution,
+    ))
+    travel_generator = TravelGenerator(config, travel_seed)
+    travels = timed(timings, "generate_travels", lambda: travel_generator.generate_travels(clusters))
+    atlas = timed(timings, "paths_between_clusters", lambda: get_paths_between_clusters(road_graph, clusters))
+    atlas_edges = timed(timings, "atlas_path_data", lambda: get_atlas_path_data(
+        road_graph, atlas, clusters, resolution,
+    ))
+    # Handing the atlas edges over keeps cluster graph pathing out of the assignment timing.
+    assigner = IncrementalBatchRouteAssigner(
+        h3_resolution=resolution,
+        batch_size=batch_size,
+        iterations_count=iterations_count,
+        atlas_edges=atlas_edges,
+    )
+    routes = timed(timings, "assign_routes", lambda: assigner.assign_routes(travels, clusters))
+
+    return {
+        "config": config_path.name,
+        "population_scale": scale,
+        "resolution": resolution,
+        "road_graph": graph_kind,
+        "road_graph_nodes": road_graph.number_of_nodes(),
+        "road_graph_edges": road_graph.number_of_edges(),
+        "batch_size": batch_size,
+        "iterations_count": iterations_count,
+        "points": len(points),
+        "clusters": len(clusters),
+        "cluster_graph_edges": assigner.graph.number_of_edges(),
+        "travels": len(travels),
+        "routes": len(routes),
+        "timings": timings,
+    }
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", nargs="+", type=pathlib.Path, default=sorted(CONFIGS_DIRECTORY.glob("*.json")))
+    parser.add_argument("--scales", nargs="+", type=float, default=[0.01, 0.05],
+                        help="multipliers applied to every epicentre population_count")
+    parser.add_argument("--resolutions", nargs="+", type=int, default=[7, 8])
+    parser.add_argument("--road-graphs", nargs="+", choices=["grid", "radial"], default=["grid", "radial"])
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--iterations-count", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("bench_report.json"))
+    return parser.parse_args()
+
+
+def main() -> None:
+    arguments = parse_arguments()
+    scenarios: List[Tuple[pathlib.Path, float, int, str]] = [
+        (config_path, scale, resolution, graph_kind)
+        for config_path in arguments.configs
+        for scale in arguments.scales
+        for resolution in arguments.resolutions
+        for graph_kind in arguments.road_graphs
+    ]
+    results = []
+    for config_path, scale, resolution, graph_kind in scenarios:
+        result = run_scenario(
+            config_path, scale, resolution, graph_kind,
+            batch_size=arguments.batch_size,
+            iterations_count=arguments.iterations_count,
+            seed=arguments.seed,
+        )
+        results.append(result)
+        print(
+            f"{config_path.name} scale={scale} resolution={resolution} graph={graph_kind}: "
+            + ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in result["timings"].items())
+        )
+
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(arguments.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
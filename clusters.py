@@ -2,49 +2,48 @@ from __future__ import annotations
 
 from collections import defaultdict
 from dataclasses import dataclass
-from statistics import mean
 from typing import List, Dict
 
 import h3
 import networkx
-import osmnx
 
-from distance import Coordinates
+from distance import Coordinates, PointSet
 from my_types import ClusterId, ClusterCentreStrategy
+from spatial import nearest_nodes, h3_cells, group_by_cell, RoadNodeCells
 
 
 @dataclass(frozen=True)
 class Cluster:
     h3_hex_id: ClusterId
     centre: Coordinates
-    points: List[Coordinates]
+    points: PointSet
 
     @staticmethod
-    def group_points(points: List[Coordinates], resolution: int) -> Dict[str, List[Coordinates]]:
-        points_by_hex_id = defaultdict(list)
-        for point in points:
-            hex_id = h3.geo_to_h3(lat=point.latitude, lng=point.longitude, resolution=resolution)
-            points_by_hex_id[hex_id].append(point)
-        return points_by_hex_id
+    def group_points(points: PointSet, resolution: int) -> Dict[str, PointSet]:
+        """
+        Groups points by their H3 cell. Points are sorted by cell once and every group is a slice (view) of
+        the sorted copy; groups keep the order in which their cells first appear in `points`.
+        """
+        hex_ids, order, offsets = group_by_cell(h3_cells(points.latitudes, points.longitudes, resolution))
+        sorted_points = points[order]
+        return {
+            hex_id: sorted_points[start:end]
+            for hex_id, start, end in zip(hex_ids, offsets[:-1].tolist(), offsets[1:].tolist())
+        }
 
     @staticmethod
     def generate_cluster_centre(
-            grouped_points: Dict[str, List[Coordinates]],
+            grouped_points: Dict[str, PointSet],
             strategy: ClusterCentreStrategy,
     ) -> Dict[str, Coordinates]:
         if strategy in (ClusterCentreStrategy.MEAN,):
-            clusters = {}
-            for hex_id, points in grouped_points.items():
-                latitudes = map(lambda point_: point_.latitude, points)
-                longitudes = map(lambda point_: point_.longitude, points)
-                clusters[hex_id] = Coordinates(latitude=mean(latitudes), longitude=mean(longitudes))
-            return clusters
+            return {hex_id: points.mean() for hex_id, points in grouped_points.items()}
         elif strategy in (ClusterCentreStrategy.HEXAGON_CENTER,):
             return {hex_id: Coordinates(*h3.h3_to_geo(hex_id)) for hex_id in grouped_points.keys()}
 
     @staticmethod
     def create_clusters(
-            points_by_hex_id: Dict[str, List[Coordinates]],
+            points_by_hex_id: Dict[str, PointSet],
             centres_by_hex_id: Dict[str, Coordinates],
             strategy: ClusterCentreStrategy,
     ) -> List[Cluster]:
@@ -54,26 +53,52 @@ class Cluster:
         ]
 
     @staticmethod
-    def clusterize_points(points: List[Coordinates], resolution: int, strategy: ClusterCentreStrategy) -> List[Cluster]:
+    def clusterize_points(points: PointSet, resolution: int, strategy: ClusterCentreStrategy) -> List[Cluster]:
         points_by_hex_id = Cluster.group_points(points, resolution)
         centres_by_hex_id = Cluster.generate_cluster_centre(points_by_hex_id, strategy)
         return Cluster.create_clusters(points_by_hex_id, centres_by_hex_id, strategy)
 
+    @staticmethod
+    def consolidation_targets(
+            clusters: List[Cluster],
+            graph: networkx.MultiDiGraph,
+            resolution: int,
+    ) -> Dict[ClusterId, ClusterId]:
+        """
+        Cluster each cluster is merged into by `consolidate_clusters`: the one containing the road node nearest to
+        its centre. Clusters whose nearest node lies outside all clusters are missing.
+        """
+        cluster_ids = {cluster.h3_hex_id for cluster in clusters}
+        centre_node_ids = nearest_nodes(
+            graph,
+            [cluster.centre.longitude for cluster in clusters],
+            [cluster.centre.latitude for cluster in clusters],
+        )
+        node_cells = RoadNodeCells.for_graph(graph, resolution)
+        return {
+            cluster.h3_hex_id: node_cells[node_id]
+            for cluster, node_id in zip(clusters, centre_node_ids.tolist())
+            if node_cells[node_id] in cluster_ids
+        }
+
     @staticmethod
     def consolidate_clusters(clusters: List[Cluster], graph: networkx.MultiDiGraph, resolution: int) -> List[Cluster]:
+        return Cluster.merge_into_targets(clusters, Cluster.consolidation_targets(clusters, graph, resolution))
+
+    @staticmethod
+    def merge_into_targets(clusters: List[Cluster], targets: Dict[ClusterId, ClusterId]) -> List[Cluster]:
+        """Clusters of `consolidate_clusters` for already computed `consolidation_targets`"""
         clusters_by_id = {cluster.h3_hex_id: cluster for cluster in clusters}
         output_clusters_by_id: Dict[ClusterId, List[Cluster]] = defaultdict(list)
         for cluster in clusters:
-            node = graph.nodes[osmnx.nearest_nodes(graph, cluster.centre.longitude, cluster.centre.latitude)]
-            nodes_cluster = h3.geo_to_h3(lat=node['y'], lng=node['x'], resolution=resolution)
-            if nodes_cluster in clusters_by_id.keys():
-                output_clusters_by_id[nodes_cluster].append(cluster)
+            if cluster.h3_hex_id in targets:
+                output_clusters_by_id[targets[cluster.h3_hex_id]].append(cluster)
 
         return [
             Cluster(
                 cluster_id,
                 clusters_by_id[cluster_id].centre,
-                points=[point for subcluster in clusters for point in subcluster.points],
+                points=PointSet.concatenate([subcluster.points for subcluster in clusters]),
             )
             for cluster_id, clusters in output_clusters_by_id.items()
         ]
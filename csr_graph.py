@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import networkx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from my_types import ClusterId
+
+NO_PREDECESSOR = -9999
+
+
+class ClusterGraphCSR:
+    """
+    Cluster graph in compressed sparse row layout.
+
+    Nodes are numbered by their position in `node_ids`, edges of node `i` occupy `indptr[i]:indptr[i + 1]` of
+    `indices` (target nodes) and `edge_links` (link ordinals, so weights can be kept as one contiguous array indexed
+    by link, e.g. `LinkStateStore.travel_times`).
+    """
+
+    def __init__(
+            self,
+            node_ids: List[ClusterId],
+            indptr: np.ndarray,
+            indices: np.ndarray,
+            edge_links: np.ndarray,
+    ) -> None:
+        self.node_ids = node_ids
+        self.node_index: Dict[ClusterId, int] = {node_id: i for i, node_id in enumerate(node_ids)}
+        self.indptr = indptr
+        self.indices = indices
+        self.edge_links = edge_links
+
+    @property
+    def nodes_count(self) -> int:
+        return len(self.node_ids)
+
+    @property
+    def edges_count(self) -> int:
+        return len(self.indices)
+
+    @staticmethod
+    def from_networkx(graph: networkx.DiGraph, link_attribute: str = "link") -> ClusterGraphCSR:
+        """Edges without `link_attribute` are numbered in the order of `graph.edges`"""
+        node_ids = list(graph.nodes)
+        node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        edges = [
+            (node_index[start], node_index[end], ordinal if link is None else link)
+            for ordinal, (start, end, link) in enumerate(graph.edges.data(link_attribute))
+        ]
+        starts = np.array([start for start, _, _ in edges], dtype=np.int32)
+        order = np.argsort(starts, kind="stable")
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(starts, minlength=len(node_ids)), out=indptr[1:])
+        indices = np.array([edges[i][1] for i in order], dtype=np.int32)
+        edge_links = np.array([edges[i][2] for i in order], dtype=np.int64)
+        return ClusterGraphCSR(node_ids, indptr, indices, edge_links)
+
+    def edge_weights(self, graph: networkx.DiGraph, weight: str = "weight") -> np.ndarray:
+        """Collects `weight` attributes of `graph` into an array indexed by link ordinal"""
+        weights = np.zeros(self.edges_count, dtype=np.float64)
+        for position, (start, end) in enumerate(self.edges()):
+            weights[self.edge_links[position]] = graph[start][end][weight]
+        return weights
+
+    def edges(self) -> Iterable[Tuple[ClusterId, ClusterId]]:
+        for start in range(self.nodes_count):
+            for position in range(self.indptr[start], self.indptr[start + 1]):
+                yield self.node_ids[start], self.node_ids[self.indices[position]]
+
+    def weight_matrix(self, link_weights: np.ndarray) -> csr_matrix:
+        return csr_matrix(
+            (link_weights[self.edge_links], self.indices, self.indptr),
+            shape=(self.nodes_count, self.nodes_count),
+        )
+
+    def shortest_path_trees(
+            self,
+            link_weights: np.ndarray,
+            sources: List[ClusterId],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Runs one batched Dijkstra from all `sources`, returning distance and predecessor rows in their order"""
+        return dijkstra(
+            self.weight_matrix(link_weights),
+            directed=True,
+            indices=[self.node_index[source] for source in sources],
+            return_predecessors=True,
+        )
+
+    def path(self, predecessors: np.ndarray, source: ClusterId, destination: ClusterId) -> List[ClusterId]:
+        """Reads the path to `destination` out of the predecessor row of `source` returned by `shortest_path_trees`"""
+        node = self.node_index[destination]
+        nodes = [node]
+        while predecessors[node] != NO_PREDECESSOR:
+            node = predecessors[node]
+            nodes.append(node)
+        if node != self.node_index[source]:
+            raise networkx.NetworkXNoPath(f"No path from {source} to {destination}")
+        return [self.node_ids[node] for node in reversed(nodes)]
+
+    def to_networkx(self, link_weights: Optional[np.ndarray] = None) -> networkx.DiGraph:
+        graph = networkx.DiGraph()
+        graph.add_nodes_from(self.node_ids)
+        for position, (start, end) in enumerate(self.edges()):
+            link = int(self.edge_links[position])
+            graph.add_edge(start, end, link=link)
+            if link_weights is not None:
+                graph[start][end]["weight"] = float(link_weights[link])
+        return graph
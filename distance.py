@@ -1,5 +1,9 @@
+from __future__ import annotations
+
 from dataclasses import dataclass
-from typing import Optional
+from typing import Iterable, Iterator, Optional, Sequence
+
+import numpy as np
 
 
 def meters_to_degrees(meters: float) -> float:
@@ -11,7 +15,44 @@ def degrees_to_meters(degrees: float) -> float:
     return degrees * 60 / (0.82/1504)
 
 
-class Distance:
+def _restore_quantity(cls: type, value: float) -> _Quantity:
+    quantity = object.__new__(cls)
+    object.__setattr__(quantity, cls._unit, value)
+    return quantity
+
+
+class _Quantity:
+    """
+    Immutable scalar kept as one float in the base unit named by `_unit`, which is the only slot of a subclass.
+
+    Quantities compare and hash by value; other units are derived on access.
+    """
+
+    __slots__ = ()
+    _unit: str
+
+    def __setattr__(self, name: str, value: object) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return _restore_quantity, (type(self), getattr(self, self._unit))
+
+    def __eq__(self, other: object) -> bool:
+        return type(other) is type(self) and getattr(other, self._unit) == getattr(self, self._unit)
+
+    def __hash__(self) -> int:
+        return hash((type(self), getattr(self, self._unit)))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self._unit}={getattr(self, self._unit)!r})"
+
+
+class Distance(_Quantity):
+    __slots__ = ("meters",)
+    _unit = "meters"
     meters: float
 
     def __init__(
@@ -22,7 +63,11 @@ class Distance:
             geo_degrees: float = 0.,
             geo_minutes: float = 0.,
     ) -> None:
-        self.meters = meters + kilometers * 1000 + centimeters / 100 + degrees_to_meters(geo_minutes + geo_degrees*60)
+        object.__setattr__(
+            self,
+            "meters",
+            meters + kilometers * 1000 + centimeters / 100 + degrees_to_meters(geo_minutes + geo_degrees*60),
+        )
 
     @property
     def kilometers(self) -> float:
@@ -41,9 +86,13 @@ class Distance:
         return self.degrees * 60
 
 
-class Time:
+class Time(_Quantity):
+    __slots__ = ("seconds",)
+    _unit = "seconds"
+    seconds: float
+
     def __init__(self, *, seconds: float = 0, minutes: float = 0, hours: float = 0) -> None:
-        self.seconds = seconds + 60 * minutes + 3600 * hours
+        object.__setattr__(self, "seconds", seconds + 60 * minutes + 3600 * hours)
 
     @property
     def minutes(self):
@@ -54,18 +103,22 @@ class Time:
         return self.seconds / 3600
 
 
-class Speed:
-    def __init__(self, *, distance: Optional[Distance] = None, time: Optional[Time] = None) -> None:
-        if distance is None:
-            distance = Distance(meters=0)
+class Speed(_Quantity):
+    __slots__ = ("meters_per_hour",)
+    _unit = "meters_per_hour"
+    meters_per_hour: float
 
-        if time is None:
-            time = Time(hours=1)
+    def __init__(self, *, distance: Optional[Distance] = None, time: Optional[Time] = None) -> None:
+        meters = distance.meters if distance is not None else 0
+        hours = time.hours if time is not None else 1
+        object.__setattr__(self, "meters_per_hour", meters / hours)
 
-        self.distance_per_hour = Distance(meters=distance.meters / time.hours)
+    @property
+    def distance_per_hour(self) -> Distance:
+        return Distance(meters=self.meters_per_hour)
 
     def distance_per_time(self, time: Time) -> Distance:
-        return Distance(meters=self.distance_per_hour.meters * time.hours)
+        return Distance(meters=self.meters_per_hour * time.hours)
 
     @property
     def distance_per_minute(self) -> Distance:
@@ -76,6 +129,14 @@ class Speed:
         return self.distance_per_time(time=Time(seconds=1))
 
 
+def travel_minutes(meters: np.ndarray, meters_per_hour: np.ndarray) -> np.ndarray:
+    """
+    Vectorized `Time(seconds=meters / speed.distance_per_second.meters).minutes` for arrays of lengths and speeds,
+    evaluated in the same order so both give identical floats.
+    """
+    return meters / (meters_per_hour * Time(seconds=1).hours) / 60
+
+
 @dataclass(frozen=True)
 class Coordinates:
     latitude: float
@@ -88,3 +149,48 @@ class Coordinates:
     @property
     def y(self) -> float:
         return self.latitude
+
+
+class PointSet:
+    """
+    Columnar collection of coordinates held as latitude and longitude float64 arrays.
+
+    Slicing returns views sharing the underlying arrays, so clusters of sorted points cost no copies.
+    Iterating yields `Coordinates` for code that works point by point.
+    """
+
+    def __init__(self, latitudes: np.ndarray, longitudes: np.ndarray) -> None:
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    @staticmethod
+    def from_coordinates(points: Iterable[Coordinates]) -> PointSet:
+        points = list(points)
+        return PointSet(
+            latitudes=np.array([point.latitude for point in points], dtype=np.float64),
+            longitudes=np.array([point.longitude for point in points], dtype=np.float64),
+        )
+
+    @staticmethod
+    def concatenate(point_sets: Sequence[PointSet]) -> PointSet:
+        if len(point_sets) == 0:
+            return PointSet(np.empty(0), np.empty(0))
+        return PointSet(
+            latitudes=np.concatenate([point_set.latitudes for point_set in point_sets]),
+            longitudes=np.concatenate([point_set.longitudes for point_set in point_sets]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.latitudes)
+
+    def __iter__(self) -> Iterator[Coordinates]:
+        for latitude, longitude in zip(self.latitudes.tolist(), self.longitudes.tolist()):
+            yield Coordinates(latitude=latitude, longitude=longitude)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return Coordinates(latitude=float(self.latitudes[item]), longitude=float(self.longitudes[item]))
+        return PointSet(latitudes=self.latitudes[item], longitudes=self.longitudes[item])
+
+    def mean(self) -> Coordinates:
+        return Coordinates(latitude=float(self.latitudes.mean()), longitude=float(self.longitudes.mean()))
@@ -0,0 +1,453 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import networkx
+import numpy as np
+
+from clusters import Cluster
+from csr_graph import ClusterGraphCSR
+from distance import Time
+from instrumentation import Instrumentation
+from link_state import LinkId, bpr_travel_times, bpr_travel_time_integrals
+from my_types import ClusterId, EquilibriumStepStrategy
+from parallel_loading import ParallelAllOrNothing
+from path_cache import ClusterGraphCache
+from pathing import AtlasEdge, RoadNetworkChange, update_atlas_edges
+from shortest_paths import ShortestPathEngine
+from traffic import ClusterGraphRouteAssigner, Route, ODRoute, route_nodes
+from travel import Travel, DemandMatrix, ODPair
+
+LinkPath = Tuple[LinkId, ...]
+
+
+@dataclass(frozen=True)
+class EquilibriumIteration:
+    iteration: int
+    relative_gap: float
+    objective: float
+    step_size: float
+    shortest_path_sweeps: int
+
+
+ClusterPath = Tuple[ClusterId, ...]
+
+
+@dataclass(frozen=True)
+class AssignmentState:
+    """
+    Everything needed to warm start an assignment: its inputs, the atlas it was solved on and the path flows of the
+    solution, with paths given as cluster sequences (empty for trips within one cluster) so they stay valid when
+    link ordinals change.
+    """
+
+    road_graph: networkx.MultiDiGraph
+    clusters: List[Cluster]
+    atlas_edges: List[AtlasEdge]
+    demand: DemandMatrix
+    path_flows: Dict[ODPair, Dict[ClusterPath, float]]
+
+
+def split_trips(path_flows: Dict[LinkPath, float], trips: int) -> List[Tuple[LinkPath, int]]:
+    """Rounds fractional path flows of one OD pair to whole trips, keeping their sum (largest remainder)"""
+    if trips == 0:
+        return []
+    total_flow = sum(path_flows.values())
+    paths = sorted(path_flows.keys(), key=lambda path_: -path_flows[path_])
+    shares = [path_flows[path] / total_flow * trips for path in paths]
+    counts = [int(share) for share in shares]
+    by_remainder = sorted(range(len(paths)), key=lambda i: counts[i] - shares[i])
+    for i in by_remainder[:trips - sum(counts)]:
+        counts[i] += 1
+    return [(path, count) for path, count in zip(paths, counts) if count > 0]
+
+
+class FrankWolfeRouteAssigner(ClusterGraphRouteAssigner):
+    """
+    Static user equilibrium assignment with the Frank-Wolfe algorithm.
+
+    Every iteration performs an all-or-nothing loading on current travel times and moves the link flows towards it
+    by a step found with line search over the Beckmann objective (or the 1/k step of the method of successive
+    averages). Solving stops once the relative gap drops below `relative_gap`; `history` describes every iteration.
+
+    With `loading_workers > 1` all-or-nothing loadings are split by origin across a pool of processes kept for the
+    duration of each assignment (see `parallel_loading`); shortest path ties are then broken as by
+    `CSRShortestPathEngine`, whatever `path_engine` is.
+    """
+
+    volume_dtype = np.float64
+
+    def __init__(
+            self,
+            h3_resolution: int,
+            relative_gap: float = 1e-4,
+            max_iterations: int = 100,
+            step_strategy: EquilibriumStepStrategy = EquilibriumStepStrategy.FRANK_WOLFE,
+            line_search_iterations: int = 30,
+            path_engine: Optional[ShortestPathEngine] = None,
+            atlas_workers: int = 1,
+            cluster_graph_cache: Optional[ClusterGraphCache] = None,
+            instrumentation: Optional[Instrumentation] = None,
+            capacity_factor: float = 1.,
+            loading_workers: int = 1,
+            atlas_edges: Optional[List[AtlasEdge]] = None,
+    ) -> None:
+        super().__init__(
+            h3_resolution,
+            path_engine=path_engine,
+            atlas_workers=atlas_workers,
+            cluster_graph_cache=cluster_graph_cache,
+            instrumentation=instrumentation,
+            capacity_factor=capacity_factor,
+            atlas_edges=atlas_edges,
+        )
+        self.loading_workers = loading_workers
+        self.parallel_loading: Optional[ParallelAllOrNothing] = None
+        self.relative_gap = relative_gap
+        self.max_iterations = max_iterations
+        self.step_strategy = step_strategy
+        self.line_search_iterations = line_search_iterations
+        self.history: List[EquilibriumIteration] = []
+        self.shortest_path_sweeps = 0
+        self.state: Optional[AssignmentState] = None
+
+    def _all_or_nothing(
+            self,
+            demand_by_origin: Dict[ClusterId, List[Tuple[ClusterId, int]]],
+    ) -> Tuple[np.ndarray, Dict[ODPair, LinkPath]]:
+        if self.parallel_loading is not None:
+            with self.instrumentation.stage("all_or_nothing", workers=self.loading_workers):
+                self.shortest_path_sweeps += len(demand_by_origin)
+                self.instrumentation.count("shortest_path_trees", len(demand_by_origin))
+                return self.parallel_loading.load(self.link_states.travel_times, demand_by_origin)
+
+        flows = np.zeros(len(self.link_states), dtype=np.float64)
+        paths: Dict[ODPair, LinkPath] = {}
+        with self.instrumentation.stage("all_or_nothing"):
+            trees_computed = self.path_engine.trees_computed
+            self.path_engine.prepare(demand_by_origin.keys())
+            for origin, destinations in demand_by_origin.items():
+                self.shortest_path_sweeps += 1
+                for destination, trips in destinations:
+                    links = tuple(self._links(self.path_engine.path(origin, destination)))
+                    flows[list(links)] += trips
+                    paths[(origin, destination)] = links
+            self.instrumentation.count("shortest_path_trees", self.path_engine.trees_computed - trees_computed)
+        return flows, paths
+
+    def _line_search(self, flows: np.ndarray, direction: np.ndarray) -> float:
+        store = self.link_states
+
+        def objective_derivative(step_: float) -> float:
+            travel_times = bpr_travel_times(store.free_flow_travel_times, flows + step_ * direction, store.capacities)
+            return float(travel_times @ direction)
+
+        if objective_derivative(0.) >= 0:
+            return 0.
+        if objective_derivative(1.) <= 0:
+            return 1.
+        lower, upper = 0., 1.
+        for _ in range(self.line_search_iterations):
+            middle = (lower + upper) / 2
+            if objective_derivative(middle) > 0:
+                upper = middle
+            else:
+                lower = middle
+        return (lower + upper) / 2
+
+    def _step_size(self, iteration: int, flows: np.ndarray, direction: np.ndarray) -> float:
+        if self.step_strategy is EquilibriumStepStrategy.FRANK_WOLFE:
+            with self.instrumentation.stage("line_search"):
+                step = self._line_search(flows, direction)
+            if 0 < step <= 1:
+                return step
+        return 1 / (iteration + 1)
+
+    def _objective(self, flows: np.ndarray) -> float:
+        store = self.link_states
+        return float(bpr_travel_time_integrals(store.free_flow_travel_times, flows, store.capacities).sum())
+
+    @staticmethod
+    def _demand_by_origin(demand: DemandMatrix) -> Dict[ClusterId, List[Tuple[ClusterId, int]]]:
+        """Destinations and trips of every origin; OD pairs without trips are left out of the assignment"""
+        demand_by_origin: Dict[ClusterId, List[Tuple[ClusterId, int]]] = defaultdict(list)
+        for (start, end), trips in demand.trips.items():
+            if trips > 0:
+                demand_by_origin[start].append((end, trips))
+        return demand_by_origin
+
+    def _equilibrate(
+            self,
+            demand: DemandMatrix,
+            flows: np.ndarray,
+            path_flows: Dict[ODPair, Dict[LinkPath, float]],
+    ) -> Dict[ODPair, Dict[LinkPath, float]]:
+        """Frank-Wolfe iterations starting from link `flows` consistent with `path_flows`, which are updated in place"""
+        demand_by_origin = self._demand_by_origin(demand)
+        self.link_states.volumes[:] = flows
+        self._update_weights()
+
+        for iteration in range(1, self.max_iterations + 1):
+            with self.instrumentation.stage("iteration", iteration=iteration):
+                auxiliary_flows, auxiliary_paths = self._all_or_nothing(demand_by_origin)
+                travel_times = self.link_states.travel_times
+                total_travel_time = float(travel_times @ flows)
+                shortest_travel_time = float(travel_times @ auxiliary_flows)
+                gap = (total_travel_time - shortest_travel_time) / total_travel_time if total_travel_time > 0 else 0.
+                if gap <= self.relative_gap:
+                    self.history.append(
+                        EquilibriumIteration(iteration, gap, self._objective(flows), 0., self.shortest_path_sweeps)
+                    )
+                    break
+
+                direction = auxiliary_flows - flows
+                step = self._step_size(iteration, flows, direction)
+                self.history.append(
+                    EquilibriumIteration(iteration, gap, self._objective(flows), step, self.shortest_path_sweeps)
+                )
+                flows = flows + step * direction
+                for od_pair, flows_by_path in path_flows.items():
+                    for path in flows_by_path:
+                        flows_by_path[path] *= 1 - step
+                    auxiliary_path = auxiliary_paths[od_pair]
+                    flows_by_path[auxiliary_path] = flows_by_path.get(auxiliary_path, 0.) + step * demand.trips[od_pair]
+                self.link_states.volumes[:] = flows
+                self._update_weights()
+
+        return path_flows
+
+    def _initial_path_flows(
+            self,
+            demand: DemandMatrix,
+            clusters: List[Cluster],
+            road_graph: networkx.MultiDiGraph,
+    ) -> Optional[Dict[ODPair, Dict[LinkPath, float]]]:
+        """
+        Path flows to start the iterations from, which may leave out some trips (see `_complete_path_flows`);
+        a free flow all-or-nothing loading when `None`
+        """
+        return None
+
+    def _complete_path_flows(
+            self,
+            demand: DemandMatrix,
+            path_flows: Dict[ODPair, Dict[LinkPath, float]],
+    ) -> Tuple[np.ndarray, Dict[ODPair, Dict[LinkPath, float]]]:
+        """
+        Link flows of `path_flows`, after the trips of `demand` they leave out are loaded on shortest paths by the
+        travel times of those flows; `path_flows` are updated in place
+        """
+        flows = np.zeros(len(self.link_states), dtype=np.float64)
+        unassigned: Dict[ClusterId, List[Tuple[ClusterId, float]]] = defaultdict(list)
+        for od_pair, trips in demand.trips.items():
+            if trips == 0:
+                continue
+            flows_by_path = path_flows.setdefault(od_pair, {})
+            for links, flow in flows_by_path.items():
+                flows[list(links)] += flow
+            missing_trips = trips - sum(flows_by_path.values())
+            if missing_trips > 1e-9 * trips:
+                unassigned[od_pair[0]].append((od_pair[1], missing_trips))
+        self.instrumentation.count("od_pairs_unassigned", sum(len(ends) for ends in unassigned.values()))
+
+        # Only origins whose trips are (partly) left out need shortest path trees on the warm flows.
+        self.link_states.volumes[:] = flows
+        self._update_weights()
+        unassigned_flows, unassigned_paths = self._all_or_nothing(unassigned)
+        for start, ends in unassigned.items():
+            for end, missing_trips in ends:
+                links = unassigned_paths[(start, end)]
+                path_flows[(start, end)][links] = path_flows[(start, end)].get(links, 0.) + missing_trips
+        return flows + unassigned_flows, path_flows
+
+    @contextmanager
+    def _loading_pool(self) -> Iterator[None]:
+        """Keeps a pool for parallel all-or-nothing loadings on the attached cluster graph while in the context"""
+        if self.loading_workers <= 1:
+            yield
+            return
+        self.parallel_loading = ParallelAllOrNothing(
+            ClusterGraphCSR.from_networkx(self.graph), len(self.link_states), self.loading_workers,
+        )
+        try:
+            yield
+        finally:
+            self.parallel_loading.close()
+            self.parallel_loading = None
+
+    def _solve(
+            self,
+            demand: DemandMatrix,
+            clusters: List[Cluster],
+            road_graph: networkx.MultiDiGraph,
+    ) -> Dict[ODPair, Dict[LinkPath, float]]:
+        self._initialize_graph(clusters, road_graph)
+        self.history = []
+        self.shortest_path_sweeps = 0
+
+        initial_path_flows = self._initial_path_flows(demand, clusters, road_graph)
+        with self._loading_pool():
+            if initial_path_flows is None:
+                flows, paths = self._all_or_nothing(self._demand_by_origin(demand))
+                path_flows = {od_pair: {path: float(demand.trips[od_pair])} for od_pair, path in paths.items()}
+            else:
+                with self.instrumentation.stage("warm_start"):
+                    flows, path_flows = self._complete_path_flows(demand, initial_path_flows)
+            path_flows = self._equilibrate(demand, flows, path_flows)
+        self._keep_state(road_graph, clusters, demand, path_flows)
+        return path_flows
+
+    def _keep_state(
+            self,
+            road_graph: networkx.MultiDiGraph,
+            clusters: List[Cluster],
+            demand: DemandMatrix,
+            path_flows: Dict[ODPair, Dict[LinkPath, float]],
+    ) -> None:
+        self.state = AssignmentState(
+            road_graph=road_graph,
+            clusters=clusters,
+            atlas_edges=self.atlas_edges,
+            demand=demand,
+            path_flows={
+                od_pair: {
+                    tuple(route_nodes(self.link_states, list(path))) if len(path) > 0 else (): flow
+                    for path, flow in flows_by_path.items()
+                }
+                for od_pair, flows_by_path in path_flows.items()
+            },
+        )
+
+    def _existing_links(self, path: ClusterPath) -> Optional[LinkPath]:
+        if any(not self.graph.has_edge(start, end) for start, end in zip(path, path[1:])):
+            return None
+        return tuple(self._links(list(path)))
+
+    def _resolve(
+            self,
+            state: AssignmentState,
+            demand: DemandMatrix,
+            clusters: List[Cluster],
+            network_change: Optional[RoadNetworkChange],
+    ) -> Dict[ODPair, Dict[LinkPath, float]]:
+        road_graph = state.road_graph
+        with self.instrumentation.stage("create_cluster_graph"):
+            if network_change is not None:
+                road_graph = network_change.apply(road_graph)
+            atlas_edges = update_atlas_edges(
+                road_graph, state.atlas_edges, state.clusters, clusters, self.h3_resolution,
+                network_change=network_change,
+                workers=self.atlas_workers,
+                instrumentation=self.instrumentation,
+            )
+        self._attach_atlas_edges(atlas_edges)
+        self.history = []
+        self.shortest_path_sweeps = 0
+
+        with self._loading_pool():
+            with self.instrumentation.stage("warm_start"):
+                path_flows: Dict[ODPair, Dict[LinkPath, float]] = {}
+                for od_pair, trips in demand.trips.items():
+                    previous_trips = state.demand.trips.get(od_pair, 0)
+                    # Pairs whose trips dropped to 0 are not assigned, and ones without previous trips start empty.
+                    if trips == 0 or previous_trips == 0:
+                        continue
+                    flows_by_path: Dict[LinkPath, float] = {}
+                    for cluster_path, flow in state.path_flows.get(od_pair, {}).items():
+                        links = self._existing_links(cluster_path)
+                        if links is not None:
+                            flows_by_path[links] = flow * trips / previous_trips
+                    path_flows[od_pair] = flows_by_path
+                flows, path_flows = self._complete_path_flows(demand, path_flows)
+            path_flows = self._equilibrate(demand, flows, path_flows)
+        self._keep_state(road_graph, clusters, demand, path_flows)
+        return path_flows
+
+    def _routes(self, travels: List[Travel], path_flows: Dict[ODPair, Dict[LinkPath, float]]) -> List[Route]:
+        travels_by_od_pair: Dict[ODPair, List[Travel]] = defaultdict(list)
+        for travel in travels:
+            travels_by_od_pair[(travel.start.h3_hex_id, travel.end.h3_hex_id)].append(travel)
+
+        routes = []
+        for od_pair, od_travels in travels_by_od_pair.items():
+            assigned = 0
+            for path, count in split_trips(path_flows[od_pair], len(od_travels)):
+                if len(path) == 0:
+                    assigned += count
+                    continue
+                estimated_travel_time = Time(minutes=self.link_states.route_travel_time(list(path)))
+                nodes = route_nodes(self.link_states, list(path))
+                routes += [
+                    Route(travel=travel, estimated_travel_time=estimated_travel_time, nodes=list(nodes))
+                    for travel in od_travels[assigned:assigned + count]
+                ]
+                assigned += count
+        return routes
+
+    def _od_routes(self, demand: DemandMatrix, path_flows: Dict[ODPair, Dict[LinkPath, float]]) -> List[ODRoute]:
+        return [
+            ODRoute(
+                start=start,
+                end=end,
+                trips=count,
+                estimated_travel_time=Time(minutes=self.link_states.route_travel_time(list(path))),
+                nodes=route_nodes(self.link_states, list(path)),
+            )
+            for (start, end), flows_by_path in path_flows.items()
+            for path, count in split_trips(flows_by_path, demand.trips[(start, end)])
+            if len(path) > 0
+        ]
+
+    def assign_routes(
+            self,
+            travels: List[Travel],
+            clusters: List[Cluster],
+            road_graph: networkx.MultiDiGraph,
+    ) -> List[Route]:
+        path_flows = self._solve(DemandMatrix.from_travels(travels, clusters), clusters, road_graph)
+        return self._routes(travels, path_flows)
+
+    def assign_demand(
+            self,
+            demand: DemandMatrix,
+            clusters: List[Cluster],
+            road_graph: networkx.MultiDiGraph,
+    ) -> List[ODRoute]:
+        path_flows = self._solve(demand, clusters, road_graph)
+        return self._od_routes(demand, path_flows)
+
+    def reassign_routes(
+            self,
+            state: AssignmentState,
+            travels: List[Travel],
+            clusters: List[Cluster],
+            network_change: Optional[RoadNetworkChange] = None,
+    ) -> List[Route]:
+        """
+        `assign_routes` for changed travels, clusters or road network, warm started from a previous `state`
+        (e.g. `self.state` after an earlier assignment), which is not modified.
+        """
+        path_flows = self._resolve(state, DemandMatrix.from_travels(travels, clusters), clusters, network_change)
+        return self._routes(travels, path_flows)
+
+    def reassign_demand(
+            self,
+            state: AssignmentState,
+            demand: Optional[DemandMatrix] = None,
+            network_change: Optional[RoadNetworkChange] = None,
+    ) -> List[ODRoute]:
+        """
+        `assign_demand` for a changed demand (by default the demand of `state`) or road network, warm started from
+        a previous `state`, which is not modified.
+
+        Atlas paths are recomputed only where a road closure, lane change or cluster change affects them (see
+        `update_atlas_edges`). Path flows of `state` are kept on paths that still exist, scaled to the new trip
+        counts of their OD pairs, and only the remaining trips are loaded on shortest paths before the usual
+        Frank-Wolfe iterations, which then typically need few sweeps to close the gap again.
+        """
+        demand = demand if demand is not None else state.demand
+        path_flows = self._resolve(state, demand, demand.clusters, network_change)
+        return self._od_routes(demand, path_flows)
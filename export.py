@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import pathlib
+from typing import TYPE_CHECKING, List
+
+import numpy as np
+import pandas as pd
+
+from link_state import LinkStateStore
+from pathing import AtlasEdge
+
+if TYPE_CHECKING:
+    from traffic import ODRoute, Route
+
+LINK_INDEX = ["start", "end"]
+
+
+def link_table(link_states: LinkStateStore) -> pd.DataFrame:
+    """
+    State of every cluster graph link indexed by `(start, end)`, built column-wise from the store arrays.
+
+    `link` is the link ordinal, times are in minutes, `path` holds the road graph nodes of the link.
+    """
+    path_data = link_states.path_data
+    return pd.DataFrame(
+        {
+            "link": np.arange(len(link_states)),
+            "travel_time": link_states.travel_times,
+            "free_flow_travel_time": link_states.free_flow_travel_times,
+            "capacity": link_states.capacities,
+            "volume": link_states.volumes,
+            "length": np.array([data.length.meters for data in path_data], dtype=np.float64),
+            "lane_count": np.array([data.minimal_lane_count for data in path_data], dtype=np.int64),
+            "path": [data.path for data in path_data],
+        },
+        index=pd.MultiIndex.from_arrays(
+            [[data.start_cluster for data in path_data], [data.end_cluster for data in path_data]],
+            names=LINK_INDEX,
+        ),
+    )
+
+
+def atlas_table(atlas_edges: List[AtlasEdge]) -> pd.DataFrame:
+    """`PathData` of every atlas edge indexed by `(start, end)`, including edges left out of the cluster graph"""
+    return pd.DataFrame(
+        {
+            "free_flow_travel_time": np.array(
+                [data.free_flow_travel_time.minutes for (_, _, data) in atlas_edges], dtype=np.float64,
+            ),
+            "capacity": np.array([data.max_capacity for (_, _, data) in atlas_edges], dtype=np.float64),
+            "length": np.array([data.length.meters for (_, _, data) in atlas_edges], dtype=np.float64),
+            "lane_count": np.array([data.minimal_lane_count for (_, _, data) in atlas_edges], dtype=np.int64),
+            "crosses_other_clusters": np.array(
+                [data.crosses_other_clusters for (_, _, data) in atlas_edges], dtype=bool,
+            ),
+            "path": [data.path for (_, _, data) in atlas_edges],
+        },
+        index=pd.MultiIndex.from_arrays(
+            [[start for (start, _, _) in atlas_edges], [end for (_, end, _) in atlas_edges]],
+            names=LINK_INDEX,
+        ),
+    )
+
+
+def route_table(routes: List[Route]) -> pd.DataFrame:
+    """One row per travel, indexed by `travel_id`; `nodes` are the clusters the route passes"""
+    return pd.DataFrame(
+        {
+            "start": [route.travel.start.h3_hex_id for route in routes],
+            "end": [route.travel.end.h3_hex_id for route in routes],
+            "estimated_travel_time": np.array(
+                [route.estimated_travel_time.minutes for route in routes], dtype=np.float64,
+            ),
+            "nodes": [route.nodes for route in routes],
+        },
+        index=pd.Index([route.travel.id_ for route in routes], name="travel_id"),
+    )
+
+
+def od_route_table(od_routes: List[ODRoute]) -> pd.DataFrame:
+    """One row per route of an OD pair, indexed by `(start, end)`"""
+    return pd.DataFrame(
+        {
+            "trips": np.array([od_route.trips for od_route in od_routes], dtype=np.int64),
+            "estimated_travel_time": np.array(
+                [od_route.estimated_travel_time.minutes for od_route in od_routes], dtype=np.float64,
+            ),
+            "nodes": [od_route.nodes for od_route in od_routes],
+        },
+        index=pd.MultiIndex.from_arrays(
+            [[od_route.start for od_route in od_routes], [od_route.end for od_route in od_routes]],
+            names=LINK_INDEX,
+        ),
+    )
+
+
+def to_arrow(table: pd.DataFrame):
+    """The table as a `pyarrow.Table`, keeping its index as columns"""
+    import pyarrow
+
+    return pyarrow.Table.from_pandas(table, preserve_index=True)
+
+
+def write_parquet(table: pd.DataFrame, path: pathlib.Path) -> None:
+    table.to_parquet(path, index=True)
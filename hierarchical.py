@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+import h3
+import networkx
+import numpy as np
+
+from clusters import Cluster
+from distance import PointSet
+from equilibrium import EquilibriumIteration, FrankWolfeRouteAssigner, LinkPath
+from instrumentation import Instrumentation
+from link_state import LinkStateStore
+from my_types import ClusterCentreStrategy, ClusterId, EquilibriumStepStrategy
+from path_cache import ClusterGraphCache
+from pathing import AtlasEdge
+from shortest_paths import ShortestPathEngine
+from travel import DemandMatrix, ODPair
+
+# Coarse paths carrying less of their OD pair's trips are not followed; their share goes to the other paths.
+MIN_COARSE_PATH_SHARE = 1e-2
+
+
+def parent_clusters(
+        clusters: List[Cluster],
+        road_graph: networkx.MultiDiGraph,
+        resolution: int,
+        strategy: ClusterCentreStrategy = ClusterCentreStrategy.HEXAGON_CENTER,
+) -> Tuple[List[Cluster], Dict[ClusterId, ClusterId]]:
+    """
+    Consolidated clusters of the H3 parents (at `resolution`) of `clusters`, and the coarse cluster every fine one
+    ended up in. Fine clusters whose parent is dropped by consolidation are missing from the mapping.
+    """
+    points_by_parent: Dict[ClusterId, List[PointSet]] = defaultdict(list)
+    parent_by_cluster: Dict[ClusterId, ClusterId] = {}
+    for cluster in clusters:
+        parent = h3.h3_to_parent(cluster.h3_hex_id, resolution)
+        points_by_parent[parent].append(cluster.points)
+        parent_by_cluster[cluster.h3_hex_id] = parent
+
+    points_by_hex_id = {parent: PointSet.concatenate(point_sets) for parent, point_sets in points_by_parent.items()}
+    centres_by_hex_id = Cluster.generate_cluster_centre(points_by_hex_id, strategy)
+    coarse_clusters = Cluster.create_clusters(points_by_hex_id, centres_by_hex_id, strategy)
+    targets = Cluster.consolidation_targets(coarse_clusters, road_graph, resolution)
+    coarse_by_cluster = {
+        cluster_id: targets[parent] for cluster_id, parent in parent_by_cluster.items() if parent in targets
+    }
+    return Cluster.merge_into_targets(coarse_clusters, targets), coarse_by_cluster
+
+
+def aggregate_demand(
+        demand: DemandMatrix,
+        coarse_clusters: List[Cluster],
+        coarse_by_cluster: Dict[ClusterId, ClusterId],
+) -> DemandMatrix:
+    """Trips between coarse clusters; trips of fine clusters without a coarse one are left out"""
+    trips: Dict[ODPair, int] = defaultdict(int)
+    for (start, end), count in demand.trips.items():
+        if start in coarse_by_cluster and end in coarse_by_cluster:
+            trips[(coarse_by_cluster[start], coarse_by_cluster[end])] += count
+    return DemandMatrix(clusters=coarse_clusters, trips=dict(trips))
+
+
+def project_link_volumes(coarse_link_states: LinkStateStore, link_states: LinkStateStore) -> np.ndarray:
+    """
+    Volumes of the links of `link_states` implied by coarse link volumes. Every coarse link loads its volume onto
+    the road edges of its path; a fine link gets the mean volume of the road edges of its own path.
+    """
+    road_edge_volumes: Dict[Tuple[int, int], float] = defaultdict(float)
+    for data, volume in zip(coarse_link_states.path_data, coarse_link_states.volumes.tolist()):
+        for road_edge in zip(data.path, data.path[1:]):
+            road_edge_volumes[road_edge] += volume
+    return np.array(
+        [
+            np.mean([road_edge_volumes.get(road_edge, 0.) for road_edge in zip(data.path, data.path[1:])])
+            for data in link_states.path_data
+        ],
+        dtype=np.float64,
+    )
+
+
+def corridor_paths(
+        graph: networkx.DiGraph,
+        origin: ClusterId,
+        corridor: Set[ClusterId],
+) -> Dict[ClusterId, List[ClusterId]]:
+    """Shortest paths (by edge `weight`) from `origin` to all clusters it reaches without leaving `corridor`"""
+    subgraph = graph.subgraph(corridor)
+    if origin not in subgraph:
+        return {}
+    return networkx.single_source_dijkstra_path(subgraph, origin, weight="weight")
+
+
+class HierarchicalRouteAssigner(FrankWolfeRouteAssigner):
+    """
+    Frank-Wolfe assignment at `h3_resolution` warm started from a solution on parent cells.
+
+    Demand is first aggregated to the consolidated H3 parents at `coarse_resolution` and solved there to
+    `coarse_relative_gap`. Every fine OD pair then splits its trips over fine paths in the proportions of the paths
+    of its coarse OD pair: each coarse path is followed by the shortest fine path that stays within the fine clusters
+    of the coarse clusters it passes. Origins are seeded one after another, on travel times of the flows seeded so
+    far plus the not yet seeded share of the coarse link volumes projected onto the fine links. Trips whose coarse
+    path cannot be followed are loaded on shortest paths, and the fine iterations start from the resulting flows.
+
+    The seed starts the fine iterations at a far lower objective than a free flow loading, but close to equilibrium
+    Frank-Wolfe converges equally slowly from either, so a coarse solution is only worth a loose `coarse_relative_gap`.
+    `coarse_assigner` and its `history` describe the coarse solution; `total_shortest_path_sweeps` counts the sweeps
+    of both resolutions, and `corridor_searches` the shortest path searches restricted to a corridor. `atlas_edges`
+    only stand for the fine cluster graph; the coarse one is always built (or loaded from `cluster_graph_cache`).
+    """
+
+    def __init__(
+            self,
+            h3_resolution: int,
+            coarse_resolution: int,
+            relative_gap: float = 1e-4,
+            coarse_relative_gap: float = 3e-2,
+            max_iterations: int = 100,
+            step_strategy: EquilibriumStepStrategy = EquilibriumStepStrategy.FRANK_WOLFE,
+            line_search_iterations: int = 30,
+            cluster_centre_strategy: ClusterCentreStrategy = ClusterCentreStrategy.HEXAGON_CENTER,
+            path_engine: Optional[ShortestPathEngine] = None,
+            coarse_path_engine: Optional[ShortestPathEngine] = None,
+            atlas_workers: int = 1,
+            cluster_graph_cache: Optional[ClusterGraphCache] = None,
+            instrumentation: Optional[Instrumentation] = None,
+            capacity_factor: float = 1.,
+            loading_workers: int = 1,
+            atlas_edges: Optional[List[AtlasEdge]] = None,
+    ) -> None:
+        if coarse_resolution >= h3_resolution:
+            raise ValueError("Coarse resolution must be lower than the assignment resolution")
+        super().__init__(
+            h3_resolution,
+            relative_gap=relative_gap,
+            max_iterations=max_iterations,
+            step_strategy=step_strategy,
+            line_search_iterations=line_search_iterations,
+            path_engine=path_engine,
+            atlas_workers=atlas_workers,
+            cluster_graph_cache=cluster_graph_cache,
+            instrumentation=instrumentation,
+            capacity_factor=capacity_factor,
+            loading_workers=loading_workers,
+            atlas_edges=atlas_edges,
+        )
+        self.coarse_resolution = coarse_resolution
+        self.cluster_centre_strategy = cluster_centre_strategy
+        self.corridor_searches = 0
+        self.coarse_assigner = FrankWolfeRouteAssigner(
+            coarse_resolution,
+            relative_gap=coarse_relative_gap,
+            max_iterations=max_iterations,
+            step_strategy=step_strategy,
+            line_search_iterations=line_search_iterations,
+            path_engine=coarse_path_engine,
+            atlas_workers=atlas_workers,
+            cluster_graph_cache=cluster_graph_cache,
+            instrumentation=instrumentation,
+            capacity_factor=capacity_factor,
+            loading_workers=loading_workers,
+        )
+
+    @property
+    def coarse_history(self) -> List[EquilibriumIteration]:
+        return self.coarse_assigner.history
+
+    @property
+    def total_shortest_path_sweeps(self) -> int:
+        return self.shortest_path_sweeps + self.coarse_assigner.shortest_path_sweeps
+
+    def _initial_path_flows(
+            self,
+            demand: DemandMatrix,
+            clusters: List[Cluster],
+            road_graph: networkx.MultiDiGraph,
+    ) -> Optional[Dict[ODPair, Dict[LinkPath, float]]]:
+        with self.instrumentation.stage("coarse", resolution=self.coarse_resolution):
+            coarse_clusters, coarse_by_cluster = parent_clusters(
+                clusters, road_graph, self.coarse_resolution, self.cluster_centre_strategy,
+            )
+            coarse_demand = aggregate_demand(demand, coarse_clusters, coarse_by_cluster)
+            self.coarse_assigner.assign_demand(coarse_demand, coarse_clusters, road_graph)
+
+        with self.instrumentation.stage("project_path_flows"):
+            projected_volumes = project_link_volumes(self.coarse_assigner.link_states, self.link_states)
+            clusters_by_coarse: Dict[ClusterId, Set[ClusterId]] = defaultdict(set)
+            for cluster_id, coarse_id in coarse_by_cluster.items():
+                clusters_by_coarse[coarse_id].add(cluster_id)
+            coarse_path_flows = self.coarse_assigner.state.path_flows
+
+            path_flows: Dict[ODPair, Dict[LinkPath, float]] = {}
+            flows = np.zeros(len(self.link_states), dtype=np.float64)
+            seeded_trips = 0.
+            self.corridor_searches = 0
+            for start, destinations in self._demand_by_origin(demand).items():
+                unseeded_share = max(1 - seeded_trips / max(demand.total_trips, 1), 0.)
+                self.link_states.volumes[:] = flows + unseeded_share * projected_volumes
+                self._update_weights()
+                paths_by_corridor: Dict[FrozenSet[ClusterId], Dict[ClusterId, List[ClusterId]]] = {}
+                for end, trips in destinations:
+                    flows_by_coarse_path = coarse_path_flows.get(
+                        (coarse_by_cluster.get(start), coarse_by_cluster.get(end)), {},
+                    )
+                    coarse_trips = sum(flows_by_coarse_path.values())
+                    followed = {
+                        coarse_path: flow for coarse_path, flow in flows_by_coarse_path.items()
+                        if flow >= MIN_COARSE_PATH_SHARE * coarse_trips
+                    }
+                    followed_trips = sum(followed.values())
+                    flows_by_path: Dict[LinkPath, float] = {}
+                    for coarse_path, flow in followed.items():
+                        # Trips within one coarse cluster have an empty coarse path and stay in that cluster.
+                        corridor = frozenset(coarse_path or (coarse_by_cluster[start],))
+                        if corridor not in paths_by_corridor:
+                            corridor_clusters = set().union(*(clusters_by_coarse[coarse_id] for coarse_id in corridor))
+                            paths_by_corridor[corridor] = corridor_paths(self.graph, start, corridor_clusters)
+                        path = paths_by_corridor[corridor].get(end)
+                        if path is not None:
+                            links = tuple(self._links(path))
+                            path_flow = trips * flow / followed_trips
+                            flows_by_path[links] = flows_by_path.get(links, 0.) + path_flow
+                            flows[list(links)] += path_flow
+                            seeded_trips += path_flow
+                    path_flows[(start, end)] = flows_by_path
+                self.corridor_searches += len(paths_by_corridor)
+            self.instrumentation.count("corridor_searches", self.corridor_searches)
+        return path_flows
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+
+@dataclass(frozen=True)
+class StageEvent:
+    stage: str
+    path: str
+    wall_time: float
+    context: Dict[str, Any]
+    counters: Dict[str, int]
+    allocated_bytes: Optional[int] = None
+    peak_bytes: Optional[int] = None
+
+
+class Instrumentation:
+    """
+    Opt-in profiling surface for assigners and pathing helpers.
+
+    This base class records nothing: `stage` hands out one shared null context and `count` returns immediately,
+    so instrumented code runs at practically full speed. Use `RecordingInstrumentation` to collect events.
+    """
+
+    enabled = False
+    _null_stage = nullcontext()
+
+    def stage(self, name: str, **context: Any) -> ContextManager[None]:
+        return self._null_stage
+
+    def count(self, name: str, amount: int = 1) -> None:
+        pass
+
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+
+@dataclass
+class _OpenStage:
+    name: str
+    path: str
+    context: Dict[str, Any]
+    started: float
+    counters: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    start_memory: int = 0
+    peak_memory: int = 0
+
+
+class RecordingInstrumentation(Instrumentation):
+    """
+    Records a `StageEvent` for every finished stage, with wall time, counters and optionally memory.
+
+    Stages nest; counters are added to every open stage, so a batch event includes the counts of its sub-stages.
+    With `trace_memory` tracemalloc is used to report net allocation and peak memory above the stage start.
+    """
+
+    enabled = True
+
+    def __init__(self, trace_memory: bool = False) -> None:
+        self.trace_memory = trace_memory
+        self.events: List[StageEvent] = []
+        self.totals: Dict[str, int] = defaultdict(int)
+        self._open_stages: List[_OpenStage] = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _memory(self) -> int:
+        current, peak = tracemalloc.get_traced_memory()
+        if self._open_stages:
+            self._open_stages[-1].peak_memory = max(self._open_stages[-1].peak_memory, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    @contextmanager
+    def _stage(self, name: str, context: Dict[str, Any]) -> Iterator[None]:
+        parent_path = self._open_stages[-1].path + "/" if self._open_stages else ""
+        open_stage = _OpenStage(name=name, path=parent_path + name, context=context, started=time.perf_counter())
+        if self.trace_memory:
+            open_stage.start_memory = self._memory()
+            open_stage.peak_memory = open_stage.start_memory
+        self._open_stages.append(open_stage)
+        try:
+            yield
+        finally:
+            allocated_bytes = peak_bytes = None
+            if self.trace_memory:
+                end_memory = self._memory()
+                allocated_bytes = end_memory - open_stage.start_memory
+                peak_bytes = open_stage.peak_memory - open_stage.start_memory
+            self._open_stages.pop()
+            if self.trace_memory and self._open_stages:
+                self._open_stages[-1].peak_memory = max(self._open_stages[-1].peak_memory, open_stage.peak_memory)
+            self.events.append(StageEvent(
+                stage=name,
+                path=open_stage.path,
+                wall_time=time.perf_counter() - open_stage.started,
+                context=context,
+                counters=dict(open_stage.counters),
+                allocated_bytes=allocated_bytes,
+                peak_bytes=peak_bytes,
+            ))
+
+    def stage(self, name: str, **context: Any) -> ContextManager[None]:
+        return self._stage(name, context)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.totals[name] += amount
+        for open_stage in self._open_stages:
+            open_stage.counters[name] += amount
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Aggregates events by stage path: number of occurrences, total and maximal wall time, summed counters"""
+        summary: Dict[str, Dict[str, float]] = {}
+        for event in self.events:
+            aggregate = summary.setdefault(event.path, {"count": 0, "wall_time": 0., "max_wall_time": 0.})
+            aggregate["count"] += 1
+            aggregate["wall_time"] += event.wall_time
+            aggregate["max_wall_time"] = max(aggregate["max_wall_time"], event.wall_time)
+            for counter, value in event.counters.items():
+                aggregate[counter] = aggregate.get(counter, 0) + value
+        return summary
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Set
+
+import numpy as np
+
+from distance import Time, travel_minutes
+from pathing import PathData
+
+TravelId = int
+LinkId = int
+
+BPR_ALPHA = .15
+BPR_BETA = 4
+
+
+def bpr_travel_times(free_flow_times: np.ndarray, volumes: np.ndarray, capacities: np.ndarray) -> np.ndarray:
+    return free_flow_times * (1 + BPR_ALPHA * (volumes / capacities) ** BPR_BETA)
+
+
+def bpr_travel_time_integrals(free_flow_times: np.ndarray, volumes: np.ndarray, capacities: np.ndarray) -> np.ndarray:
+    """Integrals of BPR travel times from zero to the given volumes, i.e. per-link terms of the Beckmann objective"""
+    return free_flow_times * (
+        volumes + BPR_ALPHA * volumes ** (BPR_BETA + 1) / ((BPR_BETA + 1) * capacities ** BPR_BETA)
+    )
+
+
+class LinkStateStore:
+    """
+    State of every cluster graph link kept in flat arrays indexed by link ordinal.
+
+    Volumes are plain integer counters (fractional flows with `volume_dtype=np.float64`);
+    the travel ids using each link are only kept when `track_travels` is set. Capacities are the hourly
+    `max_capacity` of links times `capacity_factor`, e.g. the length in hours of the period volumes are counted over.
+    """
+
+    def __init__(
+            self,
+            path_data: Sequence[PathData],
+            track_travels: bool = False,
+            volume_dtype: type = np.int64,
+            capacity_factor: float = 1.,
+    ) -> None:
+        self.path_data: List[PathData] = list(path_data)
+        self.free_flow_travel_times = travel_minutes(
+            np.array([data.length.meters for data in self.path_data], dtype=np.float64),
+            np.array([data.minimal_maximal_speed.meters_per_hour for data in self.path_data], dtype=np.float64),
+        )
+        self.capacities = np.array([data.max_capacity for data in self.path_data], dtype=np.float64) * capacity_factor
+        self.volumes = np.zeros(len(self.path_data), dtype=volume_dtype)
+        self.travel_times = self.free_flow_travel_times.copy()
+        self.travels_by_link: Optional[List[Set[TravelId]]] = (
+            [set() for _ in self.path_data] if track_travels else None
+        )
+
+    def __len__(self) -> int:
+        return len(self.path_data)
+
+    @property
+    def tracks_travels(self) -> bool:
+        return self.travels_by_link is not None
+
+    def add(self, links: Sequence[LinkId], amount: int = 1, travel_id: Optional[TravelId] = None) -> None:
+        self.volumes[links] += amount
+        if travel_id is not None and self.travels_by_link is not None:
+            for link in links:
+                self.travels_by_link[link].add(travel_id)
+
+    def remove(self, links: Sequence[LinkId], amount: int = 1, travel_id: Optional[TravelId] = None) -> None:
+        self.volumes[links] -= amount
+        if travel_id is not None and self.travels_by_link is not None:
+            for link in links:
+                self.travels_by_link[link].discard(travel_id)
+
+    def travels_on(self, link: LinkId) -> Set[TravelId]:
+        if self.travels_by_link is None:
+            raise ValueError("Link state store was created without travel tracking")
+        return self.travels_by_link[link]
+
+    def update_travel_times(self) -> np.ndarray:
+        """Recomputes BPR travel times of all links and returns ordinals of links whose time has changed"""
+        travel_times = bpr_travel_times(self.free_flow_travel_times, self.volumes, self.capacities)
+        changed_links = np.flatnonzero(travel_times != self.travel_times)
+        self.travel_times = travel_times
+        return changed_links
+
+    def route_travel_time(self, links: Sequence[LinkId]) -> float:
+        return float(self.travel_times[links].sum())
+
+
+@dataclass(frozen=True)
+class LinkState:
+    store: LinkStateStore
+    link: LinkId
+
+    @property
+    def path_data(self) -> PathData:
+        return self.store.path_data[self.link]
+
+    @property
+    def volume(self) -> int:
+        return int(self.store.volumes[self.link])
+
+    @property
+    def current_volume(self) -> List[TravelId]:
+        return list(self.store.travels_on(self.link))
+
+    @property
+    def travel_time(self) -> Time:
+        return Time(minutes=float(self.store.travel_times[self.link]))
@@ -13,3 +13,8 @@ class ClusterCentreStrategy(str, Enum):
 
 class PopulationGenerationDistributionKind(str, Enum):
     NORMAL = "NORMAL"
+
+
+class EquilibriumStepStrategy(str, Enum):
+    FRANK_WOLFE = "FRANK_WOLFE"
+    MSA = "MSA"
@@ -0,0 +1,159 @@
+"""
+All-or-nothing loading split across worker processes by origin cluster.
+
+Link costs and link flows live in shared memory: the parent writes current travel times into one array that all
+workers read, and every origin partition accumulates its flows into its own row of a flow buffer, which the parent
+sums once all partitions are loaded. Only demand and the resulting paths are pickled between processes.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+
+import networkx
+import numpy as np
+
+from csr_graph import NO_PREDECESSOR, ClusterGraphCSR
+from link_state import LinkId
+from my_types import ClusterId
+
+OriginDemand = List[Tuple[ClusterId, List[Tuple[ClusterId, float]]]]
+LoadedPaths = Dict[Tuple[ClusterId, ClusterId], Tuple[LinkId, ...]]
+
+
+class SharedArray:
+    """Float64 array backed by named shared memory, created by the parent and attached to by workers"""
+
+    def __init__(self, memory: shared_memory.SharedMemory, shape: Tuple[int, ...]) -> None:
+        self.memory = memory
+        self.shape = shape
+        self.array = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+
+    @staticmethod
+    def create(shape: Tuple[int, ...]) -> SharedArray:
+        size = max(int(np.prod(shape)), 1) * np.dtype(np.float64).itemsize
+        shared = SharedArray(shared_memory.SharedMemory(create=True, size=size), shape)
+        shared.array[...] = 0.
+        return shared
+
+    @staticmethod
+    def attach(name: str, shape: Tuple[int, ...]) -> SharedArray:
+        return SharedArray(shared_memory.SharedMemory(name=name), shape)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def close(self) -> None:
+        del self.array
+        self.memory.close()
+
+
+def partition_origins(
+        demand_by_origin: Dict[ClusterId, List[Tuple[ClusterId, float]]],
+        partitions_count: int,
+) -> List[OriginDemand]:
+    """Spreads origins over at most `partitions_count` partitions, balancing their destination counts"""
+    partitions: List[OriginDemand] = [[] for _ in range(min(partitions_count, len(demand_by_origin)))]
+    loads = [0] * len(partitions)
+    for origin, destinations in sorted(demand_by_origin.items(), key=lambda item: (-len(item[1]), item[0])):
+        lightest = loads.index(min(loads))
+        partitions[lightest].append((origin, destinations))
+        loads[lightest] += len(destinations)
+    return partitions
+
+
+_worker_csr: Optional[ClusterGraphCSR] = None
+_worker_links_by_nodes: Dict[Tuple[int, int], LinkId] = {}
+_worker_costs: Optional[SharedArray] = None
+_worker_flows: Optional[SharedArray] = None
+
+
+def _initialize_loading_worker(
+        csr: ClusterGraphCSR,
+        costs_name: str,
+        flows_name: str,
+        links_count: int,
+        partitions_count: int,
+) -> None:
+    global _worker_csr, _worker_links_by_nodes, _worker_costs, _worker_flows
+    _worker_csr = csr
+    _worker_links_by_nodes = {
+        (start, int(csr.indices[position])): int(csr.edge_links[position])
+        for start in range(csr.nodes_count)
+        for position in range(csr.indptr[start], csr.indptr[start + 1])
+    }
+    _worker_costs = SharedArray.attach(costs_name, (links_count,))
+    _worker_flows = SharedArray.attach(flows_name, (partitions_count, links_count))
+
+
+def _path_links(predecessors: np.ndarray, origin: int, destination: int) -> Tuple[LinkId, ...]:
+    links = []
+    node = destination
+    while predecessors[node] != NO_PREDECESSOR:
+        links.append(_worker_links_by_nodes[(int(predecessors[node]), node)])
+        node = int(predecessors[node])
+    if node != origin:
+        node_ids = _worker_csr.node_ids
+        raise networkx.NetworkXNoPath(f"No path from {node_ids[origin]} to {node_ids[destination]}")
+    return tuple(reversed(links))
+
+
+def _load_partition(partition: int, origin_demand: OriginDemand) -> LoadedPaths:
+    flows = _worker_flows.array[partition]
+    flows[:] = 0.
+    _, predecessors = _worker_csr.shortest_path_trees(_worker_costs.array, [origin for origin, _ in origin_demand])
+    paths: LoadedPaths = {}
+    for (origin, destinations), predecessor_row in zip(origin_demand, predecessors):
+        origin_index = _worker_csr.node_index[origin]
+        for destination, trips in destinations:
+            links = _path_links(predecessor_row, origin_index, _worker_csr.node_index[destination])
+            flows[list(links)] += trips
+            paths[(origin, destination)] = links
+    return paths
+
+
+class ParallelAllOrNothing:
+    """
+    Pool of `workers` processes loading demand on shortest paths of a fixed cluster graph, given as CSR.
+
+    Shortest path trees are computed with `ClusterGraphCSR.shortest_path_trees`, so ties are broken as in
+    `CSRShortestPathEngine`. The pool and shared memory are released by `close`.
+    """
+
+    def __init__(self, csr: ClusterGraphCSR, links_count: int, workers: int) -> None:
+        self.workers = workers
+        self.links_count = links_count
+        self.costs = SharedArray.create((links_count,))
+        self.flows = SharedArray.create((workers, links_count))
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_initialize_loading_worker,
+            initargs=(csr, self.costs.name, self.flows.name, links_count, workers),
+        )
+
+    def load(
+            self,
+            travel_times: np.ndarray,
+            demand_by_origin: Dict[ClusterId, List[Tuple[ClusterId, float]]],
+    ) -> Tuple[np.ndarray, LoadedPaths]:
+        """Link flows and paths of all OD pairs of `demand_by_origin` loaded on shortest paths by `travel_times`"""
+        self.costs.array[:] = travel_times
+        partitions = partition_origins(demand_by_origin, self.workers)
+        partition_paths: LoadedPaths = {}
+        for paths in self.executor.map(_load_partition, range(len(partitions)), partitions):
+            partition_paths.update(paths)
+        # Same order as a serial loading, so results do not depend on the partitioning.
+        paths = {
+            (origin, destination): partition_paths[(origin, destination)]
+            for origin, destinations in demand_by_origin.items()
+            for destination, _ in destinations
+        }
+        return self.flows.array[:len(partitions)].sum(axis=0), paths
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        for shared in (self.costs, self.flows):
+            shared.close()
+            shared.memory.unlink()
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import pathlib
+from typing import List, Optional, Tuple
+
+import networkx
+import numpy as np
+
+from clusters import Cluster
+from distance import Distance, Speed, Time
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from pathing import (
+    AtlasEdge,
+    PathAtlas,
+    PathData,
+    cluster_graph_from_path_data,
+    get_atlas_path_data,
+    get_paths_between_clusters,
+)
+
+CACHE_FORMAT_VERSION = 1
+
+
+def road_graph_fingerprint(graph: networkx.MultiDiGraph) -> str:
+    """Content hash of everything pathing reads from the road graph: node positions and edge attributes"""
+    digest = hashlib.sha256()
+    for node, data in sorted(graph.nodes(data=True), key=lambda item: item[0]):
+        digest.update(repr((node, data['x'], data['y'])).encode())
+    for start, end, key, data in sorted(graph.edges(keys=True, data=True), key=lambda item: item[:3]):
+        digest.update(repr((start, end, key, data.get('length'), data.get('speed_kph'), data.get('lanes'))).encode())
+    return digest.hexdigest()
+
+
+def cluster_graph_key(graph: networkx.MultiDiGraph, clusters: List[Cluster], resolution: int) -> str:
+    digest = hashlib.sha256()
+    digest.update(repr((CACHE_FORMAT_VERSION, resolution, road_graph_fingerprint(graph))).encode())
+    for cluster in sorted(clusters, key=lambda cluster_: cluster_.h3_hex_id):
+        digest.update(repr((cluster.h3_hex_id, cluster.centre.latitude, cluster.centre.longitude)).encode())
+    return digest.hexdigest()
+
+
+class ClusterGraphCache:
+    """
+    Stores path atlases together with their `PathData` in `directory`, one compressed .npz file per key.
+
+    Keys are content hashes of the road graph, the clusters (ids and centres) and the H3 resolution, so changing
+    any of these inputs simply misses the cache, while e.g. another population config with the same clusters hits it.
+    """
+
+    def __init__(self, directory: pathlib.Path) -> None:
+        self.directory = directory
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f"cluster_graph_{key}.npz"
+
+    def load(self, key: str) -> Optional[Tuple[PathAtlas, List[AtlasEdge]]]:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        with np.load(path) as arrays:
+            # NpzFile decompresses a column on every access, so each one is read once.
+            columns = {name: arrays[name].tolist() for name in arrays.files}
+        path_offsets = columns["path_offsets"]
+        path_nodes = columns["path_nodes"]
+        atlas = PathAtlas()
+        atlas_edges = []
+        for i, (from_cluster, to_cluster) in enumerate(zip(columns["from_clusters"], columns["to_clusters"])):
+            nodes = path_nodes[path_offsets[i]:path_offsets[i + 1]]
+            atlas.add_path(from_cluster, to_cluster, nodes)
+            atlas_edges.append((from_cluster, to_cluster, PathData(
+                start_cluster=columns["start_clusters"][i],
+                end_cluster=columns["end_clusters"][i],
+                minimal_maximal_speed=Speed(
+                    distance=Distance(meters=columns["meters_per_hour"][i]),
+                    time=Time(hours=1),
+                ),
+                minimal_lane_count=columns["lane_counts"][i],
+                length=Distance(meters=columns["lengths"][i]),
+                crosses_other_clusters=columns["crosses_other_clusters"][i],
+                path=nodes,
+            )))
+        return atlas, atlas_edges
+
+    def store(self, key: str, atlas_edges: List[AtlasEdge]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path_lengths = [len(data.path) for (_, _, data) in atlas_edges]
+        arrays = dict(
+            from_clusters=np.array([from_cluster for (from_cluster, _, _) in atlas_edges], dtype=str),
+            to_clusters=np.array([to_cluster for (_, to_cluster, _) in atlas_edges], dtype=str),
+            path_offsets=np.concatenate([[0], np.cumsum(path_lengths, dtype=np.int64)]).astype(np.int64),
+            path_nodes=np.array([node for (_, _, data) in atlas_edges for node in data.path], dtype=np.int64),
+            start_clusters=np.array([data.start_cluster for (_, _, data) in atlas_edges], dtype=str),
+            end_clusters=np.array([data.end_cluster for (_, _, data) in atlas_edges], dtype=str),
+            meters_per_hour=np.array(
+                [data.minimal_maximal_speed.meters_per_hour for (_, _, data) in atlas_edges],
+                dtype=np.float64,
+            ),
+            lane_counts=np.array([data.minimal_lane_count for (_, _, data) in atlas_edges], dtype=np.int64),
+            lengths=np.array([data.length.meters for (_, _, data) in atlas_edges], dtype=np.float64),
+            crosses_other_clusters=np.array(
+                [data.crosses_other_clusters for (_, _, data) in atlas_edges], dtype=bool,
+            ),
+        )
+        # Several processes may store the same key at once (see sweep.py), each writes its own temporary file.
+        temporary_path = self._path(key).with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temporary_path, self._path(key))
+
+    def get_atlas_path_data(
+            self,
+            graph: networkx.MultiDiGraph,
+            clusters: List[Cluster],
+            resolution: int,
+            workers: int = 1,
+            instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+    ) -> Tuple[PathAtlas, List[AtlasEdge]]:
+        with instrumentation.stage("cache_load"):
+            key = cluster_graph_key(graph, clusters, resolution)
+            cached = self.load(key)
+        if cached is not None:
+            instrumentation.count("cache_hits")
+            return cached
+        atlas = get_paths_between_clusters(graph, clusters, workers=workers, instrumentation=instrumentation)
+        atlas_edges = get_atlas_path_data(graph, atlas, clusters, resolution, instrumentation=instrumentation)
+        with instrumentation.stage("cache_store"):
+            self.store(key, atlas_edges)
+        return atlas, atlas_edges
+
+    def create_cluster_graph(
+            self,
+            graph: networkx.MultiDiGraph,
+            clusters: List[Cluster],
+            resolution: int,
+            workers: int = 1,
+            instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+    ) -> networkx.DiGraph:
+        _, atlas_edges = self.get_atlas_path_data(
+            graph, clusters, resolution, workers=workers, instrumentation=instrumentation,
+        )
+        return cluster_graph_from_path_data(atlas_edges)
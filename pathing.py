@@ -1,16 +1,23 @@
 from __future__ import annotations
 
+import heapq
+import math
+import weakref
 from collections import defaultdict
-from dataclasses import dataclass
-from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Collection, Dict, FrozenSet, List, Optional, Set, Tuple
 
 import h3
 import networkx
-import osmnx.distance
 
 from clusters import Cluster
 from my_types import NodeId, ClusterId
 from distance import Speed, Distance, Time
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from spatial import nearest_nodes, RoadNodeCells
+from utils import batched
 
 
 class PathAtlas:
@@ -34,35 +41,163 @@ class PathAtlas:
         ]
 
 
+ClusterPathsTask = Tuple[ClusterId, NodeId, List[Tuple[ClusterId, NodeId]]]
+ClusterPaths = Tuple[ClusterId, List[Tuple[ClusterId, Optional[List[NodeId]]]]]
+
+
+class RoadAdjacency:
+    """
+    Successors of every road graph node with the length of the shortest of their parallel edges, built once per
+    graph (use `RoadAdjacency.for_graph`) for searches that would otherwise convert the multigraph every time.
+    """
+
+    _adjacencies_by_graph: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def __init__(self, graph: networkx.MultiDiGraph) -> None:
+        self.nodes_count = graph.number_of_nodes()
+        self.edges_count = graph.number_of_edges()
+        self.successors: Dict[NodeId, List[Tuple[NodeId, float]]] = {}
+        for node, neighbours in graph.adjacency():
+            self.successors[node] = [
+                (neighbour, min(details['length'] for details in parallel_edges.values()))
+                for neighbour, parallel_edges in neighbours.items()
+            ]
+
+    @staticmethod
+    def for_graph(graph: networkx.MultiDiGraph) -> RoadAdjacency:
+        adjacency = RoadAdjacency._adjacencies_by_graph.get(graph)
+        if (
+                adjacency is None
+                or adjacency.nodes_count != graph.number_of_nodes()
+                or adjacency.edges_count != graph.number_of_edges()
+        ):
+            adjacency = RoadAdjacency(graph)
+            RoadAdjacency._adjacencies_by_graph[graph] = adjacency
+        return adjacency
+
+    def shortest_paths(self, source: NodeId, targets: Collection[NodeId]) -> Dict[NodeId, List[NodeId]]:
+        """
+        Shortest paths by length from `source` to every reachable node of `targets`, found by one Dijkstra search
+        that stops as soon as all targets are settled instead of exploring the whole graph.
+        """
+        remaining = set(targets)
+        distances: Dict[NodeId, float] = {source: 0.}
+        predecessors: Dict[NodeId, Optional[NodeId]] = {source: None}
+        settled: Set[NodeId] = set()
+        queue = [(0., 0, source)]
+        pushed = 1
+        while queue and remaining:
+            distance, _, node = heapq.heappop(queue)
+            if node in settled:
+                continue
+            settled.add(node)
+            remaining.discard(node)
+            for neighbour, length in self.successors[node]:
+                candidate = distance + length
+                if neighbour not in settled and candidate < distances.get(neighbour, math.inf):
+                    distances[neighbour] = candidate
+                    predecessors[neighbour] = node
+                    heapq.heappush(queue, (candidate, pushed, neighbour))
+                    pushed += 1
+
+        paths = {}
+        for target in targets:
+            if target not in settled:
+                continue
+            path = [target]
+            while predecessors[path[-1]] is not None:
+                path.append(predecessors[path[-1]])
+            paths[target] = path[::-1]
+        return paths
+
+
+_worker_road_graph: Optional[networkx.MultiDiGraph] = None
+
+
+def _initialize_atlas_worker(graph: networkx.MultiDiGraph) -> None:
+    global _worker_road_graph
+    _worker_road_graph = graph
+
+
+def _find_cluster_paths(graph: networkx.MultiDiGraph, task: ClusterPathsTask) -> ClusterPaths:
+    cluster_id, centroid_node_id, neighbours = task
+    paths_by_node = RoadAdjacency.for_graph(graph).shortest_paths(
+        centroid_node_id, [neighbour_centroid_node_id for _, neighbour_centroid_node_id in neighbours],
+    )
+    paths = []
+    for neighbour_id, neighbour_centroid_node_id in neighbours:
+        path_node_ids = paths_by_node.get(neighbour_centroid_node_id, [])
+        paths.append((neighbour_id, list(path_node_ids) if len(path_node_ids) >= 3 else None))
+    return cluster_id, paths
+
+
+def _find_cluster_paths_in_worker(tasks: List[ClusterPathsTask]) -> List[ClusterPaths]:
+    return [_find_cluster_paths(_worker_road_graph, task) for task in tasks]
+
+
 def get_paths_between_clusters(
         graph: networkx.MultiDiGraph,
         clusters: List[Cluster],
+        workers: int = 1,
+        instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+        cluster_pairs: Optional[Collection[Tuple[ClusterId, ClusterId]]] = None,
 ) -> PathAtlas:
-    atlas = PathAtlas()
+    """
+    Finds shortest road paths between centroids of every pair of neighbouring clusters, or only of the given
+    `cluster_pairs`, with one bounded search per origin cluster.
+
+    With `workers > 1` origin clusters are partitioned across a process pool; the road graph is sent to each worker
+    once and the resulting atlas is the same as the serial one.
+    """
     clusters_by_hex_id = {cluster.h3_hex_id: cluster for cluster in clusters}
+    with instrumentation.stage("nearest_nodes"):
+        centroid_node_ids = nearest_nodes(
+            graph,
+            [cluster.centre.longitude for cluster in clusters],
+            [cluster.centre.latitude for cluster in clusters],
+        )
     cluster_centroid_graph_node_ids_by_hex_id = {
-        cluster.h3_hex_id: osmnx.distance.nearest_nodes(graph, cluster.centre.longitude, cluster.centre.latitude)
-        for cluster in clusters
+        cluster.h3_hex_id: node_id for cluster, node_id in zip(clusters, centroid_node_ids.tolist())
     }
-    for cluster in clusters:
-        neighbours: List[Cluster] = [
-            clusters_by_hex_id[neighbour_hex_id]
-            for neighbour_hex_id in h3.k_ring(cluster.h3_hex_id, k=1)
-            if neighbour_hex_id in clusters_by_hex_id.keys()
-        ]
-        for neighbour in neighbours:
-            if atlas.path_exists(cluster.h3_hex_id, neighbour.h3_hex_id):
-                continue
+    tasks: List[ClusterPathsTask] = [
+        (
+            cluster.h3_hex_id,
+            cluster_centroid_graph_node_ids_by_hex_id[cluster.h3_hex_id],
+            [
+                (neighbour_hex_id, cluster_centroid_graph_node_ids_by_hex_id[neighbour_hex_id])
+                for neighbour_hex_id in h3.k_ring(cluster.h3_hex_id, k=1)
+                if neighbour_hex_id in clusters_by_hex_id.keys()
+                and (cluster_pairs is None or (cluster.h3_hex_id, neighbour_hex_id) in cluster_pairs)
+            ],
+        )
+        for cluster in clusters
+    ]
+    if cluster_pairs is not None:
+        tasks = [task for task in tasks if len(task[2]) > 0]
+
+    with instrumentation.stage("atlas_paths", workers=workers):
+        if workers > 1:
+            chunk_size = max(1, len(tasks) // (workers * 4))
+            with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_initialize_atlas_worker,
+                    initargs=(graph,),
+            ) as executor:
+                found_paths = [
+                    cluster_paths
+                    for chunk_paths in executor.map(_find_cluster_paths_in_worker, batched(tasks, chunk_size))
+                    for cluster_paths in chunk_paths
+                ]
+        else:
+            found_paths = [_find_cluster_paths(graph, task) for task in tasks]
+        instrumentation.count("road_paths_computed", sum(len(neighbours) for _, _, neighbours in tasks))
 
-            path_node_ids = list(osmnx.distance.k_shortest_paths(
-                graph,
-                orig=cluster_centroid_graph_node_ids_by_hex_id[cluster.h3_hex_id],
-                dest=cluster_centroid_graph_node_ids_by_hex_id[neighbour.h3_hex_id],
-                k=1,
-            ))[0]
-            if len(path_node_ids) < 3:
+    atlas = PathAtlas()
+    for cluster_id, paths in found_paths:
+        for neighbour_id, path_node_ids in paths:
+            if atlas.path_exists(cluster_id, neighbour_id) or path_node_ids is None:
                 continue
-            atlas.add_path(cluster.h3_hex_id, neighbour.h3_hex_id, path_node_ids)
+            atlas.add_path(cluster_id, neighbour_id, path_node_ids)
 
     return atlas
 
@@ -81,7 +216,7 @@ class PathData:
     def max_capacity(self) -> int:
         return self.minimal_lane_count * 2200
 
-    @property
+    @cached_property
     def free_flow_travel_time(self) -> Time:
         return Time(seconds=self.length.meters / self.minimal_maximal_speed.distance_per_second.meters)
 
@@ -97,10 +232,8 @@ def get_path_data(
         graph.get_edge_data(start, end)[0]  # TODO: Possibly multiple
         for start, end in zip(path, path[1:])
     ]
-    clusters_crossed = [
-        h3.geo_to_h3(graph.nodes[node]['y'], graph.nodes[node]['x'], resolution=resolution)
-        for node in path
-    ]
+    node_cells = RoadNodeCells.for_graph(graph, resolution)
+    clusters_crossed = [node_cells[node] for node in path]
     valid_clusters_crossed = tuple(cluster_id for cluster_id in clusters_crossed if cluster_id in valid_clusters)
     total_meters = sum(details['length'] for details in edge_details)
     minimal_maximal_kph = min(details['speed_kph'] for details in edge_details)
@@ -117,15 +250,137 @@ def get_path_data(
     )
 
 
-def create_cluster_graph(graph: networkx.MultiDiGraph, clusters: List[Cluster], resolution: int) -> networkx.DiGraph:
-    atlas = get_paths_between_clusters(graph, clusters)
+AtlasEdge = Tuple[ClusterId, ClusterId, PathData]
+
+
+def get_atlas_path_data(
+        graph: networkx.MultiDiGraph,
+        atlas: PathAtlas,
+        clusters: List[Cluster],
+        resolution: int,
+        instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+) -> List[AtlasEdge]:
     cluster_by_id = {cluster.h3_hex_id: cluster for cluster in clusters}
+    with instrumentation.stage("path_data"):
+        atlas_edges = [
+            (from_cluster, to_cluster, get_path_data(path, graph, resolution, cluster_by_id))
+            for from_cluster, destinations in atlas.path_from_cluster_id_to_cluster_id.items()
+            for to_cluster, path in destinations.items()
+        ]
+        instrumentation.count("path_data_computed", len(atlas_edges))
+    return atlas_edges
+
+
+def cluster_graph_from_path_data(atlas_edges: List[AtlasEdge]) -> networkx.DiGraph:
     edges = [
-        (from_cluster, to_cluster, {"data": get_path_data(path, graph, resolution, cluster_by_id)})
-        for from_cluster, destinations in atlas.path_from_cluster_id_to_cluster_id.items()
-        for to_cluster, path in destinations.items()
+        (from_cluster, to_cluster, {"data": data})
+        for (from_cluster, to_cluster, data) in atlas_edges
+        if not data.crosses_other_clusters
     ]
-    edges = [(from_cluster, to_cluster, data) for (from_cluster, to_cluster, data) in edges if not data["data"].crosses_other_clusters]
     cluster_graph = networkx.DiGraph()
     cluster_graph.add_edges_from(edges)
     return cluster_graph
+
+
+def create_cluster_graph(
+        graph: networkx.MultiDiGraph,
+        clusters: List[Cluster],
+        resolution: int,
+        workers: int = 1,
+        instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+) -> networkx.DiGraph:
+    atlas = get_paths_between_clusters(graph, clusters, workers=workers, instrumentation=instrumentation)
+    return cluster_graph_from_path_data(
+        get_atlas_path_data(graph, atlas, clusters, resolution, instrumentation=instrumentation)
+    )
+
+
+RoadEdge = Tuple[NodeId, NodeId]
+
+
+@dataclass(frozen=True)
+class RoadNetworkChange:
+    """
+    Closed road edges and new lane counts of road edges, each given as a `(start, end)` node pair and applied to
+    all parallel edges between them.
+    """
+
+    closed_edges: FrozenSet[RoadEdge] = frozenset()
+    lane_counts: Dict[RoadEdge, int] = field(default_factory=dict)
+
+    @property
+    def changed_edges(self) -> Set[RoadEdge]:
+        return set(self.closed_edges) | set(self.lane_counts.keys())
+
+    def apply(self, graph: networkx.MultiDiGraph) -> networkx.MultiDiGraph:
+        """Changed copy of `graph`, which itself is left intact"""
+        graph = graph.copy()
+        for start, end in self.closed_edges:
+            if graph.has_edge(start, end):
+                graph.remove_edges_from([(start, end, key) for key in list(graph[start][end].keys())])
+        for (start, end), lane_count in self.lane_counts.items():
+            for details in graph[start][end].values():
+                details['lanes'] = str(lane_count)
+        return graph
+
+
+def update_atlas_edges(
+        graph: networkx.MultiDiGraph,
+        atlas_edges: List[AtlasEdge],
+        previous_clusters: List[Cluster],
+        clusters: List[Cluster],
+        resolution: int,
+        network_change: Optional[RoadNetworkChange] = None,
+        workers: int = 1,
+        instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+) -> List[AtlasEdge]:
+    """
+    Atlas edges for `clusters` on the (already changed) road `graph`, derived from `atlas_edges` computed for
+    `previous_clusters` by recomputing only what the changes affect:
+
+    - road paths using a closed edge and paths from or to added clusters or clusters whose centre moved,
+    - `PathData` of paths using an edge with changed lanes or crossing a cell of an added or removed cluster.
+
+    Edges of removed clusters are dropped; the rest is kept as it was.
+    """
+    previous_centres = {cluster.h3_hex_id: cluster.centre for cluster in previous_clusters}
+    cluster_by_id = {cluster.h3_hex_id: cluster for cluster in clusters}
+    moved_clusters = {
+        cluster_id
+        for cluster_id, cluster in cluster_by_id.items()
+        if previous_centres.get(cluster_id) != cluster.centre
+    }
+    added_or_removed_cells = set(previous_centres.keys()) ^ set(cluster_by_id.keys())
+    closed_edges = network_change.closed_edges if network_change is not None else frozenset()
+    changed_edges = network_change.changed_edges if network_change is not None else set()
+    node_cells = RoadNodeCells.for_graph(graph, resolution)
+
+    updated_edges: List[AtlasEdge] = []
+    cluster_pairs: Set[Tuple[ClusterId, ClusterId]] = set()
+    with instrumentation.stage("path_data"):
+        for from_cluster, to_cluster, data in atlas_edges:
+            if from_cluster not in cluster_by_id or to_cluster not in cluster_by_id:
+                continue
+            if from_cluster in moved_clusters or to_cluster in moved_clusters:
+                continue
+            road_edges = set(zip(data.path, data.path[1:]))
+            if not road_edges.isdisjoint(closed_edges):
+                cluster_pairs.add((from_cluster, to_cluster))
+                continue
+            if not road_edges.isdisjoint(changed_edges) or any(
+                    node_cells[node] in added_or_removed_cells for node in data.path
+            ):
+                data = get_path_data(data.path, graph, resolution, cluster_by_id)
+                instrumentation.count("path_data_computed")
+            updated_edges.append((from_cluster, to_cluster, data))
+
+    for cluster_id in moved_clusters:
+        for neighbour_id in h3.k_ring(cluster_id, k=1):
+            if neighbour_id in cluster_by_id:
+                cluster_pairs.update({(cluster_id, neighbour_id), (neighbour_id, cluster_id)})
+    if len(cluster_pairs) > 0:
+        atlas = get_paths_between_clusters(
+            graph, clusters, workers=workers, instrumentation=instrumentation, cluster_pairs=cluster_pairs,
+        )
+        updated_edges += get_atlas_path_data(graph, atlas, clusters, resolution, instrumentation=instrumentation)
+    return updated_edges
@@ -0,0 +1,237 @@
+"""
+Runs the whole model without the notebook: config -> points -> clusters -> cluster graph -> travels -> assignment,
+and writes link and route tables (and optionally a map) to an output directory.
+
+Usage: python pipeline.py configs/slupsk_2004.json --road-graph road_graph --resolution 8 --output results
+
+The road graph is a directory written by `road_graph_store`; with `--places` it is downloaded from OSM first when
+it is missing. Every stage output is checkpointed in `--checkpoints`, under a key hashing the stage inputs and the
+key of the stage it builds on, so a rerun loads all stages up to the first one whose inputs changed and computes
+only from there. Cluster graphs are kept in a `ClusterGraphCache` inside the same directory.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import pathlib
+import pickle
+import time
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+import networkx
+import pandas as pd
+
+from clusters import Cluster
+from distance import PointSet
+from equilibrium import FrankWolfeRouteAssigner
+from export import route_table
+from my_types import ClusterCentreStrategy
+from path_cache import ClusterGraphCache, road_graph_fingerprint
+from pathing import AtlasEdge
+from population import PopulationGeneratorConfig, child_seeds, generate_population
+from road_graph_store import load_or_download_road_graph, load_road_graph
+from shortest_paths import CSRShortestPathEngine
+from traffic import ClusterGraphRouteAssigner, IncrementalBatchRouteAssigner
+from travel import Travel, TravelGenerator
+
+PIPELINE_FORMAT_VERSION = 1
+ASSIGNERS = ("incremental", "frank-wolfe")
+
+_T = TypeVar("_T")
+
+
+class Checkpoints:
+    """Pickled stage outputs in `directory`, one file per stage and key"""
+
+    def __init__(self, directory: pathlib.Path) -> None:
+        self.directory = directory
+
+    @staticmethod
+    def key(stage: str, *inputs: Any) -> str:
+        return hashlib.sha256(repr((PIPELINE_FORMAT_VERSION, stage, inputs)).encode()).hexdigest()
+
+    def _path(self, stage: str, key: str) -> pathlib.Path:
+        return self.directory / f"{stage}_{key}.pkl"
+
+    def run(self, stage: str, key: str, compute: Callable[[], _T]) -> _T:
+        """Output of `stage` stored under `key`, computed (and stored) only when there is none yet"""
+        path = self._path(stage, key)
+        if path.exists():
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            print(f"{stage}: resumed from checkpoint")
+            return result
+
+        started = time.perf_counter()
+        result = compute()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temporary_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary_path, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+        print(f"{stage}: computed in {time.perf_counter() - started:.3f}s")
+        return result
+
+
+def file_digest(path: pathlib.Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def load_stage_road_graph(directory: pathlib.Path, places: Optional[List[str]]) -> networkx.MultiDiGraph:
+    if places:
+        return load_or_download_road_graph(directory, places)
+    return load_road_graph(directory)
+
+
+def create_assigner(arguments: argparse.Namespace, atlas_edges: List[AtlasEdge]) -> ClusterGraphRouteAssigner:
+    if arguments.assigner == "frank-wolfe":
+        return FrankWolfeRouteAssigner(
+            h3_resolution=arguments.resolution,
+            relative_gap=arguments.relative_gap,
+            max_iterations=arguments.max_iterations,
+            atlas_workers=arguments.workers,
+            atlas_edges=atlas_edges,
+            # CSR shortest paths break ties the same way in parallel loadings, so results do not depend on workers.
+            path_engine=CSRShortestPathEngine(),
+            loading_workers=arguments.workers,
+        )
+    return IncrementalBatchRouteAssigner(
+        h3_resolution=arguments.resolution,
+        batch_size=arguments.batch_size,
+        iterations_count=arguments.iterations_count,
+        atlas_workers=arguments.workers,
+        atlas_edges=atlas_edges,
+    )
+
+
+def assigner_parameters(arguments: argparse.Namespace) -> Tuple:
+    if arguments.assigner == "frank-wolfe":
+        return arguments.assigner, arguments.relative_gap, arguments.max_iterations
+    return arguments.assigner, arguments.batch_size, arguments.iterations_count
+
+
+def assign(
+        assigner: ClusterGraphRouteAssigner,
+        travels: List[Travel],
+        clusters: List[Cluster],
+        road_graph: networkx.MultiDiGraph,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    routes = assigner.assign_routes(travels, clusters, road_graph)
+    return assigner.link_table(), route_table(routes)
+
+
+def write_table(table: pd.DataFrame, path: pathlib.Path) -> None:
+    if path.suffix == ".parquet":
+        table.to_parquet(path, index=True)
+    else:
+        table.to_csv(path, index=True)
+
+
+def write_map(
+        path: pathlib.Path,
+        road_graph: networkx.MultiDiGraph,
+        clusters: List[Cluster],
+        links: pd.DataFrame,
+) -> None:
+    """Clusters and link paths (line widths by volume) on one folium map"""
+    import folium
+
+    from utils import rescale, visualize_clusters_layer, visualize_weighted_paths_layer
+
+    # Centred on the road graph, so there is a map even without clusters.
+    xs = [x for _, x in road_graph.nodes(data="x")]
+    ys = [y for _, y in road_graph.nodes(data="y")]
+    map_ = folium.Map(location=((min(ys) + max(ys)) / 2, (min(xs) + max(xs)) / 2), zoom_start=13)
+    # Tooltips of an empty GeoJSON layer fail to render, so layers without features are left out.
+    if len(clusters) > 0:
+        visualize_clusters_layer(map_, clusters)
+    loaded = links[links["volume"] > 0]
+    if len(loaded) > 0:
+        max_volume = float(loaded["volume"].max())
+        visualize_weighted_paths_layer(
+            map_,
+            road_graph,
+            loaded["path"].tolist(),
+            colors=["darkred"] * len(loaded),
+            weights=[rescale(float(volume), max_volume, 0., 8., 1.) for volume in loaded["volume"].tolist()],
+            tooltips=[f"{start} -> {end}: {volume:g}" for (start, end), volume in loaded["volume"].items()],
+            name="links",
+        )
+    folium.LayerControl().add_to(map_)
+    map_.save(str(path))
+
+
+def run_pipeline(arguments: argparse.Namespace) -> None:
+    checkpoints = Checkpoints(arguments.checkpoints)
+    cache = ClusterGraphCache(arguments.checkpoints / "cluster_graphs")
+    population_seed, travel_seed = child_seeds(arguments.seed, 2)
+
+    config = PopulationGeneratorConfig.from_json_file(arguments.config)
+    road_graph = load_stage_road_graph(arguments.road_graph, arguments.places)
+
+    # Points only depend on the epicentres, so other config changes (e.g. travel_coefficient) keep them.
+    points_key = Checkpoints.key("points", config.epicentres, arguments.seed)
+    points: PointSet = checkpoints.run(
+        "points", points_key, lambda: generate_population(config, population_seed, workers=arguments.workers),
+    )
+
+    clusters_key = Checkpoints.key(
+        "clusters", points_key, road_graph_fingerprint(road_graph), arguments.resolution, arguments.cluster_centre,
+    )
+    clusters: List[Cluster] = checkpoints.run("clusters", clusters_key, lambda: Cluster.consolidate_clusters(
+        Cluster.clusterize_points(points, arguments.resolution, arguments.cluster_centre),
+        road_graph,
+        arguments.resolution,
+    ))
+
+    started = time.perf_counter()
+    _, atlas_edges = cache.get_atlas_path_data(road_graph, clusters, arguments.resolution, workers=arguments.workers)
+    print(f"cluster_graph: ready in {time.perf_counter() - started:.3f}s")
+
+    travels_key = Checkpoints.key("travels", clusters_key, file_digest(arguments.config), arguments.seed)
+    travels: List[Travel] = checkpoints.run(
+        "travels", travels_key, lambda: TravelGenerator(config, travel_seed).generate_travels(clusters),
+    )
+
+    assignment_key = Checkpoints.key("assignment", travels_key, assigner_parameters(arguments))
+    links, routes = checkpoints.run("assignment", assignment_key, lambda: assign(
+        create_assigner(arguments, atlas_edges), travels, clusters, road_graph,
+    ))
+
+    arguments.output.mkdir(parents=True, exist_ok=True)
+    write_table(links.drop(columns="path"), arguments.output / f"links.{arguments.format}")
+    write_table(routes.assign(nodes=routes["nodes"].map(" ".join)), arguments.output / f"routes.{arguments.format}")
+    if arguments.map:
+        write_map(arguments.output / "map.html", road_graph, clusters, links)
+    print(f"written to {arguments.output}")
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("config", type=pathlib.Path)
+    parser.add_argument("--road-graph", type=pathlib.Path, required=True)
+    parser.add_argument("--places", nargs="+", help="OSM places to download the road graph from when it is missing")
+    parser.add_argument("--resolution", type=int, default=8)
+    parser.add_argument("--cluster-centre", type=ClusterCentreStrategy, default=ClusterCentreStrategy.HEXAGON_CENTER,
+                        choices=list(ClusterCentreStrategy))
+    parser.add_argument("--assigner", choices=ASSIGNERS, default="incremental")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--iterations-count", type=int, default=1)
+    parser.add_argument("--relative-gap", type=float, default=1e-4)
+    parser.add_argument("--max-iterations", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--checkpoints", type=pathlib.Path, default=pathlib.Path(".pipeline_checkpoints"))
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("pipeline_output"))
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--map", action="store_true", help="also draw clusters and loaded links into map.html")
+    return parser.parse_args()
+
+
+def main() -> None:
+    run_pipeline(parse_arguments())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,13 @@ from __future__ import annotations
 
 import json
 import pathlib
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional, Union
 
 import numpy as np
 
-from distance import Distance, Coordinates
+from distance import Distance, PointSet
 from my_types import PopulationGenerationDistributionKind
 
 
@@ -31,10 +33,31 @@ class PopulationGenerationEpicentre:
         )
 
 
+@dataclass(frozen=True)
+class TimeSlice:
+    """
+    Departure period of travels: `share` of all travels start within its `hours`.
+
+    Link capacities are per hour, so a slice is assigned against capacities scaled by its length.
+    """
+    label: str
+    hours: float
+    share: float
+
+    @staticmethod
+    def from_json_record(record: dict[str, str]) -> TimeSlice:
+        return TimeSlice(label=record['label'], hours=float(record['hours']), share=float(record['share']))
+
+
+# Single period compared against hourly capacities, i.e. what assigners did before travels had time slices.
+STATIC_TIME_SLICES = [TimeSlice(label="static", hours=1., share=1.)]
+
+
 @dataclass
 class PopulationGeneratorConfig:
     epicentres: list[PopulationGenerationEpicentre]
     travel_coefficient: float
+    time_slices: list[TimeSlice] = field(default_factory=lambda: list(STATIC_TIME_SLICES))
 
     @staticmethod
     def from_json_file(path: pathlib.Path) -> PopulationGeneratorConfig:
@@ -45,15 +68,63 @@ class PopulationGeneratorConfig:
                     PopulationGenerationEpicentre.from_json_record(record) for record in config["epicentres"]
                 ],
                 travel_coefficient=config["travel_coefficient"],
+                time_slices=[
+                    TimeSlice.from_json_record(record) for record in config.get("time_slices", [])
+                ] or list(STATIC_TIME_SLICES),
             )
 
 
-def generate_data_points(epicentre: PopulationGenerationEpicentre) -> list[Coordinates]:
+Seed = Union[None, int, np.random.SeedSequence]
+
+
+def seed_sequence(seed: Seed) -> np.random.SeedSequence:
+    """`seed` itself when it already is a `SeedSequence`, otherwise a new one (with fresh entropy for `None`)"""
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+
+def child_seeds(seed: Seed, count: int) -> List[np.random.SeedSequence]:
+    """Children `seed.spawn(count)` would give, without advancing `seed`, so every call returns the same ones"""
+    parent = seed_sequence(seed)
     return [
-        Coordinates(longitude=longitude, latitude=latitude)
-        for longitude, latitude in np.random.normal(
-            loc=(epicentre.longitude, epicentre.latitude),
-            scale=(epicentre.radius.degrees, epicentre.radius.degrees),
-            size=(epicentre.population_count, 2)
-        )
+        np.random.SeedSequence(parent.entropy, spawn_key=parent.spawn_key + (i,), pool_size=parent.pool_size)
+        for i in range(count)
     ]
+
+
+def generate_data_points(
+        epicentre: PopulationGenerationEpicentre,
+        rng: Optional[np.random.Generator] = None,
+) -> PointSet:
+    if rng is None:
+        rng = np.random.default_rng()
+    longitudes, latitudes = rng.normal(
+        loc=(epicentre.longitude, epicentre.latitude),
+        scale=(epicentre.radius.degrees, epicentre.radius.degrees),
+        size=(epicentre.population_count, 2)
+    ).T
+    return PointSet(latitudes=latitudes, longitudes=longitudes)
+
+
+def _generate_epicentre_points(epicentre: PopulationGenerationEpicentre, seed: np.random.SeedSequence) -> PointSet:
+    return generate_data_points(epicentre, np.random.default_rng(seed))
+
+
+def generate_population(config: PopulationGeneratorConfig, seed: Seed = None, workers: int = 1) -> PointSet:
+    """
+    Points of all epicentres, concatenated in config order.
+
+    Every epicentre draws from its own generator seeded with a child of `seed`, so a given seed gives
+    bit-identical points no matter how many `workers` processes generate them.
+    """
+    epicentre_seeds = child_seeds(seed, len(config.epicentres))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            point_sets: List[PointSet] = list(
+                executor.map(_generate_epicentre_points, config.epicentres, epicentre_seeds)
+            )
+    else:
+        point_sets = [
+            _generate_epicentre_points(epicentre, epicentre_seed)
+            for epicentre, epicentre_seed in zip(config.epicentres, epicentre_seeds)
+        ]
+    return PointSet.concatenate(point_sets)
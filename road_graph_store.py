@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import shutil
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import networkx
+import numpy as np
+
+ROAD_GRAPH_FORMAT_VERSION = 1
+METADATA_FILE = "metadata.json"
+NODE_ARRAYS = ("node_ids", "x", "y")
+EDGE_ARRAYS = ("edge_starts", "edge_ends", "edge_keys", "length", "speed_kph", "travel_time", "lanes")
+
+
+@dataclass
+class RoadGraphArrays:
+    """
+    Processed road graph as flat columns: nodes (`node_ids`, `x`, `y`) and edges (`edge_starts`, `edge_ends`,
+    `edge_keys`, `length`, `speed_kph`, `travel_time`, `lanes`).
+
+    Every column is stored as its own .npy file, so a stored graph can be opened memory-mapped. Missing
+    `travel_time` is NaN and missing `lanes` is an empty string. Other attributes, edge `geometry` included, are
+    dropped: only the columns above are read by pathing, and drawn paths fall back to straight lines between nodes.
+    """
+
+    node_ids: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    edge_starts: np.ndarray
+    edge_ends: np.ndarray
+    edge_keys: np.ndarray
+    length: np.ndarray
+    speed_kph: np.ndarray
+    travel_time: np.ndarray
+    lanes: np.ndarray
+    metadata: Dict
+
+    @staticmethod
+    def from_networkx(graph: networkx.MultiDiGraph, metadata: Optional[Dict] = None) -> RoadGraphArrays:
+        nodes = list(graph.nodes(data=True))
+        edges = list(graph.edges(keys=True, data=True))
+        return RoadGraphArrays(
+            node_ids=np.array([node for node, _ in nodes], dtype=np.int64),
+            x=np.array([data['x'] for _, data in nodes], dtype=np.float64),
+            y=np.array([data['y'] for _, data in nodes], dtype=np.float64),
+            edge_starts=np.array([start for start, _, _, _ in edges], dtype=np.int64),
+            edge_ends=np.array([end for _, end, _, _ in edges], dtype=np.int64),
+            edge_keys=np.array([key for _, _, key, _ in edges], dtype=np.int64),
+            length=np.array([data['length'] for _, _, _, data in edges], dtype=np.float64),
+            speed_kph=np.array([data['speed_kph'] for _, _, _, data in edges], dtype=np.float64),
+            travel_time=np.array([data.get('travel_time', np.nan) for _, _, _, data in edges], dtype=np.float64),
+            # Only the first lanes entry is ever read (see pathing.get_path_data), lists keep just that one.
+            lanes=np.array([_first_lanes(data.get('lanes')) for _, _, _, data in edges], dtype=str),
+            metadata={"crs": str(graph.graph.get("crs", "epsg:4326")), **(metadata or {})},
+        )
+
+    def to_networkx(self) -> networkx.MultiDiGraph:
+        graph = networkx.MultiDiGraph(crs=self.metadata.get("crs"))
+        graph.add_nodes_from(
+            (node, {'x': x, 'y': y})
+            for node, x, y in zip(self.node_ids.tolist(), self.x.tolist(), self.y.tolist())
+        )
+        graph.add_edges_from(
+            (start, end, key, _edge_attributes(length, speed_kph, travel_time, lanes))
+            for start, end, key, length, speed_kph, travel_time, lanes in zip(
+                self.edge_starts.tolist(),
+                self.edge_ends.tolist(),
+                self.edge_keys.tolist(),
+                self.length.tolist(),
+                self.speed_kph.tolist(),
+                self.travel_time.tolist(),
+                self.lanes.tolist(),
+            )
+        )
+        return graph
+
+    def save(self, directory: pathlib.Path) -> None:
+        """
+        Writes all columns next to a metadata file; a previous store in `directory` is replaced at once, while any
+        other non-empty `directory` is left untouched and raises a `ValueError`
+        """
+        _check_replaceable(directory)
+        temporary_directory = directory.with_name(directory.name + ".tmp")
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        temporary_directory.mkdir(parents=True)
+        for name in NODE_ARRAYS + EDGE_ARRAYS:
+            np.save(temporary_directory / f"{name}.npy", getattr(self, name), allow_pickle=False)
+        with open(temporary_directory / METADATA_FILE, "w") as f:
+            json.dump({"format_version": ROAD_GRAPH_FORMAT_VERSION, **self.metadata}, f, indent=2)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary_directory, directory)
+
+    @staticmethod
+    def load(directory: pathlib.Path, mmap_mode: Optional[str] = "r") -> RoadGraphArrays:
+        with open(directory / METADATA_FILE, "r") as f:
+            metadata = json.load(f)
+        if metadata.pop("format_version", None) != ROAD_GRAPH_FORMAT_VERSION:
+            raise ValueError(f"Road graph at {directory} was stored in an unsupported format")
+        columns = {
+            name: np.load(directory / f"{name}.npy", mmap_mode=mmap_mode, allow_pickle=False)
+            for name in NODE_ARRAYS + EDGE_ARRAYS
+        }
+        return RoadGraphArrays(metadata=metadata, **columns)
+
+
+def _check_replaceable(directory: pathlib.Path) -> None:
+    """Raises unless `directory` is missing, empty or holds a stored road graph, i.e. can be saved into"""
+    if not directory.exists():
+        return
+    if not directory.is_dir():
+        raise ValueError(f"Cannot store a road graph at {directory}, which is not a directory")
+    if not (directory / METADATA_FILE).exists() and any(directory.iterdir()):
+        raise ValueError(f"Cannot store a road graph in {directory}, which holds other files")
+
+
+def _first_lanes(lanes) -> str:
+    if lanes is None:
+        return ""
+    if isinstance(lanes, list):
+        return str(lanes[0])
+    return str(lanes)
+
+
+def _edge_attributes(length: float, speed_kph: float, travel_time: float, lanes: str) -> dict:
+    attributes = {'length': length, 'speed_kph': speed_kph}
+    if not np.isnan(travel_time):
+        attributes['travel_time'] = travel_time
+    if lanes:
+        attributes['lanes'] = lanes
+    return attributes
+
+
+def download_road_graph(places: List[str], custom_filter: Optional[str] = None) -> networkx.MultiDiGraph:
+    import osmnx
+
+    graph = osmnx.graph.graph_from_place(places, network_type="drive", custom_filter=custom_filter)
+    return osmnx.speed.add_edge_travel_times(osmnx.add_edge_speeds(graph))
+
+
+def save_road_graph(graph: networkx.MultiDiGraph, directory: pathlib.Path, metadata: Optional[Dict] = None) -> None:
+    RoadGraphArrays.from_networkx(graph, metadata).save(directory)
+
+
+def load_road_graph(directory: pathlib.Path) -> networkx.MultiDiGraph:
+    return RoadGraphArrays.load(directory).to_networkx()
+
+
+def load_or_download_road_graph(
+        directory: pathlib.Path,
+        places: List[str],
+        custom_filter: Optional[str] = None,
+) -> networkx.MultiDiGraph:
+    """
+    Loads the road graph stored in `directory`, or downloads and processes it from OSM (speeds and travel times)
+    and stores it there when nothing was stored yet for the same `places` and `custom_filter`.
+
+    A fresh download is returned as read back from `directory`, so every run sees the same graph.
+    """
+    source = {"places": list(places), "custom_filter": custom_filter}
+    if (directory / METADATA_FILE).exists():
+        arrays = RoadGraphArrays.load(directory)
+        if arrays.metadata.get("source") == source:
+            return arrays.to_networkx()
+    _check_replaceable(directory)
+    save_road_graph(download_road_graph(places, custom_filter), directory, metadata={"source": source})
+    return load_road_graph(directory)
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional
+
+import networkx
+import numpy as np
+
+from csr_graph import ClusterGraphCSR
+from link_state import LinkStateStore
+from my_types import ClusterId
+
+
+class ShortestPathEngine(ABC):
+    def __init__(self, weight: str = "weight") -> None:
+        self.weight = weight
+        self.graph: Optional[networkx.DiGraph] = None
+        self.link_states: Optional[LinkStateStore] = None
+        self.trees_computed = 0
+
+    def attach(self, graph: networkx.DiGraph, link_states: Optional[LinkStateStore] = None) -> None:
+        self.graph = graph
+        self.link_states = link_states
+        self.invalidate()
+
+    def prepare(self, origins: Iterable[ClusterId]) -> None:
+        """Hint that paths from `origins` are about to be asked for, so engines can compute them together"""
+        pass
+
+    @abstractmethod
+    def path(self, origin: ClusterId, destination: ClusterId) -> List[ClusterId]:
+        pass
+
+    @abstractmethod
+    def invalidate(self) -> None:
+        pass
+
+
+class AllPairsShortestPathEngine(ShortestPathEngine):
+    """Materialises paths between every pair of clusters, recomputed on first use after each invalidation."""
+
+    def __init__(self, weight: str = "weight") -> None:
+        super().__init__(weight)
+        self.paths: Optional[Dict[ClusterId, Dict[ClusterId, List[ClusterId]]]] = None
+
+    def path(self, origin: ClusterId, destination: ClusterId) -> List[ClusterId]:
+        if self.paths is None:
+            self.paths = dict(networkx.all_pairs_dijkstra_path(self.graph, weight=self.weight))
+            self.trees_computed += len(self.paths)
+        return self.paths[origin][destination]
+
+    def invalidate(self) -> None:
+        self.paths = None
+
+
+class SingleSourceShortestPathEngine(ShortestPathEngine):
+    """Builds a shortest path tree only for origins that are asked for and keeps it until weights change."""
+
+    def __init__(self, weight: str = "weight") -> None:
+        super().__init__(weight)
+        self.trees: Dict[ClusterId, Dict[ClusterId, List[ClusterId]]] = {}
+
+    def path(self, origin: ClusterId, destination: ClusterId) -> List[ClusterId]:
+        if origin not in self.trees:
+            self.trees[origin] = networkx.single_source_dijkstra_path(self.graph, origin, weight=self.weight)
+            self.trees_computed += 1
+        return self.trees[origin][destination]
+
+    def invalidate(self) -> None:
+        self.trees = {}
+
+
+class CSRShortestPathEngine(ShortestPathEngine):
+    """
+    Runs batched Dijkstra from all prepared origins at once on a CSR copy of the graph.
+
+    Link weights are read from the attached `LinkStateStore` travel times, or from the `weight` edge attributes
+    when the engine is used without one. Ties between equally long paths may be broken differently than networkx.
+    """
+
+    def __init__(self, weight: str = "weight") -> None:
+        super().__init__(weight)
+        self.csr: Optional[ClusterGraphCSR] = None
+        self.predecessors: Dict[ClusterId, np.ndarray] = {}
+
+    def attach(self, graph: networkx.DiGraph, link_states: Optional[LinkStateStore] = None) -> None:
+        self.csr = ClusterGraphCSR.from_networkx(graph)
+        super().attach(graph, link_states)
+
+    def _link_weights(self) -> np.ndarray:
+        if self.link_states is not None:
+            return self.link_states.travel_times
+        return self.csr.edge_weights(self.graph, self.weight)
+
+    def prepare(self, origins: Iterable[ClusterId]) -> None:
+        missing_origins = list(dict.fromkeys(origin for origin in origins if origin not in self.predecessors))
+        if len(missing_origins) == 0:
+            return
+        _, predecessors = self.csr.shortest_path_trees(self._link_weights(), missing_origins)
+        self.trees_computed += len(missing_origins)
+        for origin, row in zip(missing_origins, predecessors):
+            self.predecessors[origin] = row
+
+    def path(self, origin: ClusterId, destination: ClusterId) -> List[ClusterId]:
+        if origin not in self.predecessors:
+            self.prepare([origin])
+        return self.csr.path(self.predecessors[origin], origin, destination)
+
+    def invalidate(self) -> None:
+        self.predecessors = {}
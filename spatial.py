@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import math
+import weakref
+from typing import Dict, List, Sequence, Tuple
+
+import h3
+import h3.api.basic_int as h3_int
+import networkx
+import numpy as np
+from scipy.spatial import cKDTree
+
+from my_types import ClusterId, NodeId
+
+EARTH_RADIUS_METERS = 6_371_009
+
+
+class RoadNodeIndex:
+    """
+    KD-tree over road graph nodes, kept in an equirectangular projection (meters) around the graph's mean latitude.
+
+    Use `RoadNodeIndex.for_graph` to share one index between all lookups on the same graph.
+    """
+
+    _indices_by_graph: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def __init__(self, graph: networkx.MultiDiGraph) -> None:
+        node_ids, longitudes, latitudes = zip(*(
+            (node, data['x'], data['y']) for node, data in graph.nodes(data=True)
+        ))
+        self.node_ids = np.array(node_ids)
+        self.nodes_count = len(node_ids)
+        self.reference_latitude = float(np.mean(latitudes))
+        self.tree = cKDTree(self._project(np.asarray(longitudes), np.asarray(latitudes)))
+
+    def _project(self, longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+        x = np.radians(longitudes) * math.cos(math.radians(self.reference_latitude)) * EARTH_RADIUS_METERS
+        y = np.radians(latitudes) * EARTH_RADIUS_METERS
+        return np.column_stack((x, y))
+
+    @staticmethod
+    def for_graph(graph: networkx.MultiDiGraph) -> RoadNodeIndex:
+        index = RoadNodeIndex._indices_by_graph.get(graph)
+        if index is None or index.nodes_count != graph.number_of_nodes():
+            index = RoadNodeIndex(graph)
+            RoadNodeIndex._indices_by_graph[graph] = index
+        return index
+
+    def nearest_nodes(self, longitudes: Sequence[float], latitudes: Sequence[float]) -> np.ndarray:
+        _, positions = self.tree.query(
+            self._project(np.asarray(longitudes, dtype=np.float64), np.asarray(latitudes, dtype=np.float64)),
+        )
+        return self.node_ids[positions]
+
+    def nearest_node(self, longitude: float, latitude: float) -> NodeId:
+        return self.nearest_nodes([longitude], [latitude])[0].item()
+
+
+def nearest_nodes(graph: networkx.MultiDiGraph, longitudes: Sequence[float], latitudes: Sequence[float]) -> np.ndarray:
+    return RoadNodeIndex.for_graph(graph).nearest_nodes(longitudes, latitudes)
+
+
+def h3_cells(latitudes: np.ndarray, longitudes: np.ndarray, resolution: int) -> np.ndarray:
+    """
+    H3 cells of all coordinates as an uint64 array (integer cell representation, see `h3.h3_to_string`).
+
+    The h3 bindings index one point per call, so this is the single place looping over coordinates; everything
+    downstream (sorting, grouping, counting) works on the integer array.
+    """
+    return np.fromiter(
+        (
+            h3_int.geo_to_h3(latitude, longitude, resolution)
+            for latitude, longitude in zip(np.asarray(latitudes).tolist(), np.asarray(longitudes).tolist())
+        ),
+        dtype=np.uint64,
+        count=len(latitudes),
+    )
+
+
+def group_by_cell(cells: np.ndarray) -> Tuple[List[ClusterId], np.ndarray, np.ndarray]:
+    """
+    Groups positions of `cells` without per-element Python work.
+
+    Returns cell ids in order of their first appearance, a stable permutation sorting positions by group and
+    offsets such that `order[offsets[i]:offsets[i + 1]]` are positions belonging to the i-th cell.
+    """
+    unique_cells, first_indices, inverse, counts = np.unique(
+        cells, return_index=True, return_inverse=True, return_counts=True,
+    )
+    group_order = np.argsort(first_indices, kind="stable")
+    group_ranks = np.empty_like(group_order)
+    group_ranks[group_order] = np.arange(len(group_order))
+    order = np.argsort(group_ranks[inverse.reshape(-1)], kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(counts[group_order])])
+    return [h3.h3_to_string(int(cell)) for cell in unique_cells[group_order]], order, offsets
+
+
+class RoadNodeCells:
+    """H3 cell of every road graph node, computed once per graph and resolution"""
+
+    _cells_by_graph: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def __init__(self, graph: networkx.MultiDiGraph, resolution: int) -> None:
+        node_ids, longitudes, latitudes = zip(*(
+            (node, data['x'], data['y']) for node, data in graph.nodes(data=True)
+        ))
+        cells = h3_cells(np.asarray(latitudes), np.asarray(longitudes), resolution)
+        unique_cells, inverse = np.unique(cells, return_inverse=True)
+        cell_ids = [h3.h3_to_string(int(cell)) for cell in unique_cells]
+        self.nodes_count = len(node_ids)
+        self.cell_by_node: Dict[NodeId, ClusterId] = {
+            node_id: cell_ids[cell] for node_id, cell in zip(node_ids, inverse.reshape(-1).tolist())
+        }
+
+    @staticmethod
+    def for_graph(graph: networkx.MultiDiGraph, resolution: int) -> Dict[NodeId, ClusterId]:
+        cells_by_resolution = RoadNodeCells._cells_by_graph.setdefault(graph, {})
+        node_cells = cells_by_resolution.get(resolution)
+        if node_cells is None or node_cells.nodes_count != graph.number_of_nodes():
+            node_cells = RoadNodeCells(graph, resolution)
+            cells_by_resolution[resolution] = node_cells
+        return node_cells.cell_by_node
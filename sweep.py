@@ -0,0 +1,208 @@
+"""
+Runs `IncrementalBatchRouteAssigner` over every combination of population configs, H3 resolutions, batch sizes
+and iteration counts of a sweep spec and collects link states of all scenarios into one table.
+
+Usage: python sweep.py sweep.json --workers 8 --output sweep_links.csv
+
+Example spec (paths are relative to the spec file; `road_graph` is a directory written by `road_graph_store`):
+
+    {
+        "road_graph": "road_graph",
+        "cluster_graph_cache": "cluster_graph_cache",
+        "configs": ["configs/slupsk_2004.json", "configs/slupsk_2004_hyperpopulated.json"],
+        "resolutions": [7, 8],
+        "batch_sizes": [10, 200],
+        "iterations_counts": [1, 4],
+        "cluster_centre_strategy": "HEXAGON_CENTER",
+        "seed": 0
+    }
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+import networkx
+import pandas as pd
+
+from clusters import Cluster
+from my_types import ClusterCentreStrategy
+from path_cache import ClusterGraphCache
+from population import PopulationGeneratorConfig, child_seeds, generate_population
+from road_graph_store import load_road_graph
+from traffic import IncrementalBatchRouteAssigner
+from travel import TravelGenerator
+
+_T = TypeVar("_T")
+
+
+@dataclass(frozen=True)
+class Scenario:
+    config: pathlib.Path
+    resolution: int
+    batch_size: int
+    iterations_count: int
+    cluster_centre_strategy: ClusterCentreStrategy
+    seed: int
+
+
+@dataclass
+class SweepSpec:
+    road_graph: pathlib.Path
+    cluster_graph_cache: pathlib.Path
+    configs: List[pathlib.Path]
+    resolutions: List[int]
+    batch_sizes: List[int]
+    iterations_counts: List[int]
+    cluster_centre_strategy: ClusterCentreStrategy = ClusterCentreStrategy.HEXAGON_CENTER
+    seed: int = 0
+
+    @staticmethod
+    def from_json_file(path: pathlib.Path) -> SweepSpec:
+        with open(path, 'r') as f:
+            spec = json.load(f)
+        base_directory = path.resolve().parent
+        return SweepSpec(
+            road_graph=base_directory / spec["road_graph"],
+            cluster_graph_cache=base_directory / spec["cluster_graph_cache"],
+            configs=[base_directory / config for config in spec["configs"]],
+            resolutions=[int(resolution) for resolution in spec["resolutions"]],
+            batch_sizes=[int(batch_size) for batch_size in spec.get("batch_sizes", [200])],
+            iterations_counts=[int(iterations_count) for iterations_count in spec.get("iterations_counts", [1])],
+            cluster_centre_strategy=ClusterCentreStrategy[spec.get("cluster_centre_strategy", "HEXAGON_CENTER")],
+            seed=int(spec.get("seed", 0)),
+        )
+
+    def scenarios(self) -> List[Scenario]:
+        return [
+            Scenario(
+                config=config,
+                resolution=resolution,
+                batch_size=batch_size,
+                iterations_count=iterations_count,
+                cluster_centre_strategy=self.cluster_centre_strategy,
+                seed=self.seed,
+            )
+            for config, resolution, batch_size, iterations_count in itertools.product(
+                self.configs, self.resolutions, self.batch_sizes, self.iterations_counts,
+            )
+        ]
+
+
+_worker_road_graph: Optional[networkx.MultiDiGraph] = None
+_worker_cache: Optional[ClusterGraphCache] = None
+
+
+def _initialize_sweep_worker(road_graph_directory: pathlib.Path, cache_directory: pathlib.Path) -> None:
+    global _worker_road_graph, _worker_cache
+    _worker_road_graph = load_road_graph(road_graph_directory)
+    _worker_cache = ClusterGraphCache(cache_directory)
+
+
+def _scenario_clusters(
+        scenario: Scenario,
+        road_graph: networkx.MultiDiGraph,
+) -> Tuple[PopulationGeneratorConfig, List[Cluster]]:
+    config = PopulationGeneratorConfig.from_json_file(scenario.config)
+    population_seed, _ = child_seeds(scenario.seed, 2)
+    points = generate_population(config, population_seed)
+    clusters = Cluster.consolidate_clusters(
+        Cluster.clusterize_points(points, scenario.resolution, scenario.cluster_centre_strategy),
+        road_graph,
+        scenario.resolution,
+    )
+    return config, clusters
+
+
+def _warm_cluster_graph_cache(scenario: Scenario) -> None:
+    _, clusters = _scenario_clusters(scenario, _worker_road_graph)
+    _worker_cache.get_atlas_path_data(_worker_road_graph, clusters, scenario.resolution)
+
+
+def _run_scenario(scenario: Scenario) -> pd.DataFrame:
+    config, clusters = _scenario_clusters(scenario, _worker_road_graph)
+    _, travel_seed = child_seeds(scenario.seed, 2)
+    travels = TravelGenerator(config, travel_seed).generate_travels(clusters)
+    assigner = IncrementalBatchRouteAssigner(
+        h3_resolution=scenario.resolution,
+        batch_size=scenario.batch_size,
+        iterations_count=scenario.iterations_count,
+        cluster_graph_cache=_worker_cache,
+    )
+    assigner.assign_routes(travels, clusters, _worker_road_graph)
+    return assigner.link_table().drop(columns="path").reset_index().assign(
+        config=scenario.config.name,
+        resolution=scenario.resolution,
+        batch_size=scenario.batch_size,
+        iterations_count=scenario.iterations_count,
+        seed=scenario.seed,
+    )
+
+
+def _map(
+        function: Callable[[Scenario], _T],
+        scenarios: List[Scenario],
+        executor: Optional[ProcessPoolExecutor],
+) -> List[_T]:
+    if executor is None:
+        return [function(scenario) for scenario in scenarios]
+    return list(executor.map(function, scenarios))
+
+
+def run_sweep(spec: SweepSpec, workers: int = 1) -> pd.DataFrame:
+    """
+    Runs all scenarios of `spec` and concatenates their link tables, scenario parameters being extra columns.
+
+    Every worker loads the stored road graph once. Cluster graphs are shared through the spec's
+    `ClusterGraphCache`: they are built first, once per config and resolution, so that scenarios which differ only
+    in assigner parameters never compute the same atlas concurrently. Points and travels are drawn from generators
+    seeded by the scenario seed, so results do not depend on the number of workers.
+    """
+    scenarios = spec.scenarios()
+    cluster_graph_scenarios: Dict[Tuple[pathlib.Path, int], Scenario] = {}
+    for scenario in scenarios:
+        cluster_graph_scenarios.setdefault((scenario.config, scenario.resolution), scenario)
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_initialize_sweep_worker,
+            initargs=(spec.road_graph, spec.cluster_graph_cache),
+        )
+    else:
+        _initialize_sweep_worker(spec.road_graph, spec.cluster_graph_cache)
+    try:
+        _map(_warm_cluster_graph_cache, list(cluster_graph_scenarios.values()), executor)
+        link_tables = _map(_run_scenario, scenarios, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return pd.concat(link_tables, ignore_index=True)
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("spec", type=pathlib.Path)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("sweep_links.csv"),
+                        help="link table, written as parquet when the name ends with .parquet and as csv otherwise")
+    return parser.parse_args()
+
+
+def main() -> None:
+    arguments = parse_arguments()
+    links = run_sweep(SweepSpec.from_json_file(arguments.spec), workers=arguments.workers)
+    if arguments.output.suffix == ".parquet":
+        links.to_parquet(arguments.output, index=False)
+    else:
+        links.to_csv(arguments.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Assignment of travels departing in different time slices (e.g. morning peak, midday, night) of a day.
+
+Every slice is assigned on its own, against link capacities scaled by the slice length, but all slices share the
+cluster graph built once for the clusters. Slices are independent, so they are assigned concurrently in worker
+processes, and their link states and routes are merged into single tables.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import networkx
+import pandas as pd
+
+from clusters import Cluster
+from export import LINK_INDEX, route_table
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from my_types import ClusterId
+from path_cache import ClusterGraphCache
+from pathing import AtlasEdge, get_atlas_path_data, get_paths_between_clusters
+from population import TimeSlice
+from traffic import IncrementalBatchRouteAssigner
+from travel import Travel
+
+SliceTravels = List[Tuple[int, ClusterId, ClusterId]]
+
+
+@dataclass(frozen=True)
+class SliceAssignmentParameters:
+    h3_resolution: int
+    batch_size: int = 200
+    iterations_count: int = 1
+
+
+@dataclass
+class TimeSlicedAssignment:
+    """
+    Results of all slices: `links` indexed by `(time_slice, start, end)` and `routes` indexed by `travel_id`,
+    both with the slice label in a `time_slice` column. Road paths of links are in `atlas_edges`.
+    """
+
+    time_slices: List[TimeSlice]
+    atlas_edges: List[AtlasEdge]
+    links: pd.DataFrame
+    routes: pd.DataFrame
+
+
+_worker_clusters: List[Cluster] = []
+_worker_atlas_edges: List[AtlasEdge] = []
+_worker_parameters: Optional[SliceAssignmentParameters] = None
+
+
+def _initialize_slice_worker(
+        clusters: List[Cluster],
+        atlas_edges: List[AtlasEdge],
+        parameters: SliceAssignmentParameters,
+) -> None:
+    global _worker_clusters, _worker_atlas_edges, _worker_parameters
+    _worker_clusters = clusters
+    _worker_atlas_edges = atlas_edges
+    _worker_parameters = parameters
+
+
+def _assign_slice(time_slice: TimeSlice, slice_travels: SliceTravels) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    cluster_by_id: Dict[ClusterId, Cluster] = {cluster.h3_hex_id: cluster for cluster in _worker_clusters}
+    travels = [
+        Travel(start=cluster_by_id[start], end=cluster_by_id[end], id_=travel_id)
+        for travel_id, start, end in slice_travels
+    ]
+    assigner = IncrementalBatchRouteAssigner(
+        h3_resolution=_worker_parameters.h3_resolution,
+        batch_size=_worker_parameters.batch_size,
+        iterations_count=_worker_parameters.iterations_count,
+        capacity_factor=time_slice.hours,
+        atlas_edges=_worker_atlas_edges,
+    )
+    routes = assigner.assign_routes(travels, _worker_clusters)
+    return (
+        assigner.link_table().drop(columns="path").assign(time_slice=time_slice.label),
+        route_table(routes).assign(time_slice=time_slice.label),
+    )
+
+
+def assign_time_slices(
+        travels: List[Travel],
+        clusters: List[Cluster],
+        road_graph: networkx.MultiDiGraph,
+        time_slices: List[TimeSlice],
+        parameters: SliceAssignmentParameters,
+        workers: int = 1,
+        atlas_workers: int = 1,
+        cluster_graph_cache: Optional[ClusterGraphCache] = None,
+        instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+) -> TimeSlicedAssignment:
+    """
+    Assigns the travels of every slice (by `Travel.time_slice`, an index into `time_slices`) with an
+    `IncrementalBatchRouteAssigner` whose capacities are multiplied by the slice length in hours.
+
+    The cluster graph is built (or loaded from `cluster_graph_cache`) once, then sent to each of `workers`
+    processes together with the clusters, so every slice only ships the ids of its travels.
+    """
+    with instrumentation.stage("create_cluster_graph"):
+        if cluster_graph_cache is not None:
+            _, atlas_edges = cluster_graph_cache.get_atlas_path_data(
+                road_graph, clusters, parameters.h3_resolution, workers=atlas_workers, instrumentation=instrumentation,
+            )
+        else:
+            atlas = get_paths_between_clusters(
+                road_graph, clusters, workers=atlas_workers, instrumentation=instrumentation,
+            )
+            atlas_edges = get_atlas_path_data(
+                road_graph, atlas, clusters, parameters.h3_resolution, instrumentation=instrumentation,
+            )
+
+    travels_by_slice: List[SliceTravels] = [[] for _ in time_slices]
+    for travel in travels:
+        travels_by_slice[travel.time_slice].append((travel.id_, travel.start.h3_hex_id, travel.end.h3_hex_id))
+
+    with instrumentation.stage("assign_time_slices", time_slices=len(time_slices), workers=workers):
+        if workers > 1:
+            with ProcessPoolExecutor(
+                    max_workers=min(workers, len(time_slices)),
+                    initializer=_initialize_slice_worker,
+                    initargs=(clusters, atlas_edges, parameters),
+            ) as executor:
+                results = list(executor.map(_assign_slice, time_slices, travels_by_slice))
+        else:
+            _initialize_slice_worker(clusters, atlas_edges, parameters)
+            results = [
+                _assign_slice(time_slice, slice_travels)
+                for time_slice, slice_travels in zip(time_slices, travels_by_slice)
+            ]
+
+    return TimeSlicedAssignment(
+        time_slices=time_slices,
+        atlas_edges=atlas_edges,
+        links=pd.concat([links for links, _ in results]).reset_index().set_index(["time_slice", *LINK_INDEX]),
+        routes=pd.concat([routes for _, routes in results]).sort_index(),
+    )
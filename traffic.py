@@ -1,17 +1,22 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, field
-from typing import List, Dict
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Dict, Optional
 
 import networkx
+import numpy as np
+import pandas as pd
 
 from clusters import Cluster
 from distance import Time
-from pathing import PathData, create_cluster_graph
-from travel import Travel
+from export import atlas_table, link_table
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from link_state import LinkStateStore, LinkState, LinkId, TravelId
+from path_cache import ClusterGraphCache
+from pathing import AtlasEdge, cluster_graph_from_path_data, get_atlas_path_data, get_paths_between_clusters
+from shortest_paths import ShortestPathEngine, SingleSourceShortestPathEngine
+from travel import Travel, DemandMatrix, ODPair
 from my_types import ClusterId
-from utils import batched
-
-TravelId = int
+from utils import batched, chunked
 
 
 @dataclass
@@ -21,6 +26,15 @@ class Route:
     nodes: List[ClusterId]
 
 
+@dataclass
+class ODRoute:
+    start: ClusterId
+    end: ClusterId
+    trips: int
+    estimated_travel_time: Time
+    nodes: List[ClusterId]
+
+
 class TravelRouteAssigner(ABC):
     @abstractmethod
     def assign_routes(
@@ -31,65 +45,307 @@ class TravelRouteAssigner(ABC):
     ) -> List[Route]:
         pass
 
+    @abstractmethod
+    def assign_demand(
+            self,
+            demand: DemandMatrix,
+            clusters: List[Cluster],
+            road_graph: networkx.MultiDiGraph,
+    ) -> List[ODRoute]:
+        pass
+
+
+def route_nodes(store: LinkStateStore, links: List[LinkId]) -> List[ClusterId]:
+    return [store.path_data[link].start_cluster for link in links] + [store.path_data[links[~0]].end_cluster]
 
-@dataclass
-class LinkState:
-    path_data: PathData
-    current_volume: List[TravelId] = field(default_factory=list)
 
-    @property
-    def travel_time(self) -> Time:
-        minutes = self.path_data.free_flow_travel_time.minutes * \
-            (1 + .15 * (len(self.current_volume) / self.path_data.max_capacity) ** 4)
-        return Time(minutes=minutes)
+def expand_od_routes(od_routes: List[ODRoute], clusters: List[Cluster], first_travel_id: int = 1) -> List[Route]:
+    """One route per trip of `od_routes`, with travels numbered from `first_travel_id` in order"""
+    cluster_by_id = {cluster.h3_hex_id: cluster for cluster in clusters}
+    expanded = (od_route for od_route in od_routes for _ in range(od_route.trips))
+    return [
+        Route(
+            travel=Travel(start=cluster_by_id[od_route.start], end=cluster_by_id[od_route.end], id_=travel_id),
+            estimated_travel_time=od_route.estimated_travel_time,
+            nodes=list(od_route.nodes),
+        )
+        for travel_id, od_route in enumerate(expanded, start=first_travel_id)
+    ]
 
 
-class IncrementalBatchRouteAssigner(TravelRouteAssigner):
-    def __init__(self, h3_resolution: int, batch_size: int = 200, iterations_count: int = 1) -> None:
+class ClusterGraphRouteAssigner(TravelRouteAssigner, ABC):
+    """
+    Base for assigners working on the cluster graph, whose link states live in a `LinkStateStore`.
+
+    The cluster graph is built from `atlas_edges` when they are given (computed beforehand for the same clusters and
+    `h3_resolution`), otherwise loaded from `cluster_graph_cache` or computed from the road graph on every assignment.
+    Assigners given `atlas_edges` never read the road graph, so `IncrementalBatchRouteAssigner` then needs none.
+    """
+
+    volume_dtype = np.int64
+
+    def __init__(
+            self,
+            h3_resolution: int,
+            path_engine: Optional[ShortestPathEngine] = None,
+            track_travels: bool = False,
+            atlas_workers: int = 1,
+            cluster_graph_cache: Optional[ClusterGraphCache] = None,
+            instrumentation: Optional[Instrumentation] = None,
+            capacity_factor: float = 1.,
+            atlas_edges: Optional[List[AtlasEdge]] = None,
+    ) -> None:
         self.h3_resolution = h3_resolution
+        self.path_engine = path_engine if path_engine is not None else SingleSourceShortestPathEngine()
+        self.track_travels = track_travels
+        self.atlas_workers = atlas_workers
+        self.cluster_graph_cache = cluster_graph_cache
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        self.capacity_factor = capacity_factor
+        self.precomputed_atlas_edges = atlas_edges
+        self.graph = None
+        self.atlas_edges: List[AtlasEdge] = []
+        self.link_states: Optional[LinkStateStore] = None
+        self._edge_attributes: List[dict] = []
+
+    def _initialize_graph(self, clusters: List[Cluster], road_graph: Optional[networkx.MultiDiGraph]) -> None:
+        with self.instrumentation.stage("create_cluster_graph"):
+            if self.precomputed_atlas_edges is not None:
+                atlas_edges = self.precomputed_atlas_edges
+            elif self.cluster_graph_cache is not None:
+                _, atlas_edges = self.cluster_graph_cache.get_atlas_path_data(
+                    road_graph, clusters, self.h3_resolution,
+                    workers=self.atlas_workers,
+                    instrumentation=self.instrumentation,
+                )
+            else:
+                atlas = get_paths_between_clusters(
+                    road_graph, clusters,
+                    workers=self.atlas_workers,
+                    instrumentation=self.instrumentation,
+                )
+                atlas_edges = get_atlas_path_data(
+                    road_graph, atlas, clusters, self.h3_resolution, instrumentation=self.instrumentation,
+                )
+        self._attach_atlas_edges(atlas_edges)
+
+    def _attach_atlas_edges(self, atlas_edges: List[AtlasEdge]) -> None:
+        self.atlas_edges = atlas_edges
+        self.graph = cluster_graph_from_path_data(atlas_edges)
+        edges = list(self.graph.edges.data("data"))
+        self.link_states = LinkStateStore(
+            [data for (_, _, data) in edges],
+            track_travels=self.track_travels,
+            volume_dtype=self.volume_dtype,
+            capacity_factor=self.capacity_factor,
+        )
+        self._edge_attributes = [self.graph[start][end] for (start, end, _) in edges]
+        for link, attributes in enumerate(self._edge_attributes):
+            attributes["link"] = link
+            attributes["state"] = LinkState(self.link_states, link)
+            attributes["weight"] = float(self.link_states.travel_times[link])
+        self.path_engine.attach(self.graph, self.link_states)
+
+    def link_table(self) -> pd.DataFrame:
+        """Current link states as a table indexed by `(start, end)`, see `export.link_table`"""
+        return link_table(self.link_states)
+
+    def atlas_table(self) -> pd.DataFrame:
+        """Path data of all atlas edges the cluster graph was built from, see `export.atlas_table`"""
+        return atlas_table(self.atlas_edges)
+
+    def _update_weights(self) -> None:
+        with self.instrumentation.stage("update_weights"):
+            changed_links = self.link_states.update_travel_times()
+            travel_times = self.link_states.travel_times
+            for link in changed_links:
+                self._edge_attributes[link]["weight"] = float(travel_times[link])
+            if len(changed_links) > 0:
+                self.path_engine.invalidate()
+            self.instrumentation.count("links_updated", len(changed_links))
+
+    def _links(self, path: List[ClusterId]) -> List[LinkId]:
+        return [self.graph[start][stop]["link"] for start, stop in zip(path, path[1:])]
+
+    def _shortest_paths(self, od_pairs: List[ODPair]) -> List[List[ClusterId]]:
+        with self.instrumentation.stage("shortest_paths"):
+            trees_computed = self.path_engine.trees_computed
+            self.path_engine.prepare(start for start, _ in od_pairs)
+            paths = [self.path_engine.path(start, end) for start, end in od_pairs]
+            self.instrumentation.count("shortest_path_trees", self.path_engine.trees_computed - trees_computed)
+            return paths
+
+
+class IncrementalBatchRouteAssigner(ClusterGraphRouteAssigner):
+    def __init__(
+            self,
+            h3_resolution: int,
+            batch_size: int = 200,
+            iterations_count: int = 1,
+            path_engine: Optional[ShortestPathEngine] = None,
+            track_travels: bool = False,
+            atlas_workers: int = 1,
+            cluster_graph_cache: Optional[ClusterGraphCache] = None,
+            instrumentation: Optional[Instrumentation] = None,
+            capacity_factor: float = 1.,
+            atlas_edges: Optional[List[AtlasEdge]] = None,
+    ) -> None:
+        super().__init__(
+            h3_resolution,
+            path_engine=path_engine,
+            track_travels=track_travels,
+            atlas_workers=atlas_workers,
+            cluster_graph_cache=cluster_graph_cache,
+            instrumentation=instrumentation,
+            capacity_factor=capacity_factor,
+            atlas_edges=atlas_edges,
+        )
         self.batch_size = batch_size
         self.iterations_count = iterations_count
-        self.graph = None
+
+    def _load_travels(
+            self,
+            travels: List[Travel],
+            paths: List[List[ClusterId]],
+            current_routes: Dict[TravelId, List[LinkId]],
+    ) -> None:
+        with self.instrumentation.stage("load"):
+            rerouted, links_touched = 0, 0
+            for travel, path in zip(travels, paths):
+                links = self._links(path)
+                former_links = current_routes.get(travel.id_)
+                if former_links is not None:
+                    if former_links == links:
+                        continue
+                    self.link_states.remove(former_links, travel_id=travel.id_)
+                    links_touched += len(former_links)
+                    rerouted += 1
+
+                current_routes[travel.id_] = links
+                self.link_states.add(links, travel_id=travel.id_)
+                links_touched += len(links)
+            self.instrumentation.count("travels_rerouted", rerouted)
+            self.instrumentation.count("links_touched", links_touched)
+
+    def _load_od_pairs(
+            self,
+            od_pairs: List[ODPair],
+            paths: List[List[ClusterId]],
+            demand: DemandMatrix,
+            current_routes: Dict[ODPair, List[LinkId]],
+    ) -> None:
+        with self.instrumentation.stage("load"):
+            rerouted, links_touched = 0, 0
+            for od_pair, path in zip(od_pairs, paths):
+                trips = demand.trips[od_pair]
+                links = self._links(path)
+                former_links = current_routes.get(od_pair)
+                if former_links is not None:
+                    if former_links == links:
+                        continue
+                    self.link_states.remove(former_links, amount=trips)
+                    links_touched += len(former_links)
+                    rerouted += trips
+
+                current_routes[od_pair] = links
+                self.link_states.add(links, amount=trips)
+                links_touched += len(links)
+            self.instrumentation.count("travels_rerouted", rerouted)
+            self.instrumentation.count("links_touched", links_touched)
 
     def assign_routes(
             self,
             travels: List[Travel],
             clusters: List[Cluster],
-            road_graph: networkx.MultiDiGraph,
+            road_graph: Optional[networkx.MultiDiGraph] = None,
     ) -> List[Route]:
         travel_by_id = {travel.id_: travel for travel in travels}
-        self.graph = create_cluster_graph(road_graph, clusters, self.h3_resolution)
-        for (start, end, data) in self.graph.edges.data("data"):
-            state = LinkState(data)
-            self.graph[start][end]["state"] = state
-            self.graph[start][end]["weight"] = state.travel_time.minutes
+        self._initialize_graph(clusters, road_graph)
 
-        current_routes: Dict[TravelId, List[LinkState]] = {}
+        current_routes: Dict[TravelId, List[LinkId]] = {}
         for iteration in range(self.iterations_count):
-            for travels_batch in batched(travels, self.batch_size):
-                shortest_paths = dict(networkx.all_pairs_dijkstra_path(self.graph))
-                for travel in travels_batch:
-                    path = shortest_paths[travel.start.h3_hex_id][travel.end.h3_hex_id]
-                    link_states = [self.graph[start][stop]["state"] for start, stop in zip(path, path[1:])]
-                    for former_link_state in current_routes.get(travel.id_, []):
-                        former_link_state.current_volume.remove(travel.id_)
-
-                    current_routes[travel.id_] = link_states
-                    for link_state in link_states:
-                        link_state.current_volume.append(travel.id_)
-
-                for (start, end, state) in self.graph.edges.data("state"):
-                    self.graph[start][end]["weight"] = state.travel_time.minutes
+            with self.instrumentation.stage("iteration", iteration=iteration):
+                for batch, travels_batch in enumerate(batched(travels, self.batch_size)):
+                    with self.instrumentation.stage("batch", iteration=iteration, batch=batch):
+                        paths = self._shortest_paths(
+                            [(travel.start.h3_hex_id, travel.end.h3_hex_id) for travel in travels_batch]
+                        )
+                        self._load_travels(travels_batch, paths, current_routes)
+                        self._update_weights()
 
         return [
             Route(
                 travel=travel_by_id[travel_id],
-                estimated_travel_time=Time(minutes=sum(link.travel_time.minutes for link in current_route)),
-                nodes=[
-                          link.path_data.start_cluster
-                          for link in current_route
-                      ] + [current_route[~0].path_data.end_cluster],
+                estimated_travel_time=Time(minutes=self.link_states.route_travel_time(current_route)),
+                nodes=route_nodes(self.link_states, current_route),
             )
             for travel_id, current_route in current_routes.items()
             if len(current_route) > 0
         ]
+
+    def stream_routes(
+            self,
+            travels: Iterable[Travel],
+            clusters: List[Cluster],
+            road_graph: Optional[networkx.MultiDiGraph] = None,
+    ) -> Iterator[Route]:
+        """
+        Single incremental pass of `assign_routes` over any iterable of travels, e.g. chained chunks of
+        `TravelGenerator.iter_travels`. Routes are yielded batch by batch, estimated with the link states right after
+        their batch was loaded, and nothing is kept per travel, so memory is bounded by the batch and the link states.
+        """
+        if self.iterations_count != 1:
+            raise ValueError("Streaming assignment makes a single pass and needs iterations_count=1")
+        self._initialize_graph(clusters, road_graph)
+
+        for batch, travels_batch in enumerate(chunked(travels, self.batch_size)):
+            with self.instrumentation.stage("batch", iteration=0, batch=batch):
+                paths = self._shortest_paths(
+                    [(travel.start.h3_hex_id, travel.end.h3_hex_id) for travel in travels_batch]
+                )
+                batch_routes: Dict[TravelId, List[LinkId]] = {}
+                self._load_travels(travels_batch, paths, batch_routes)
+                self._update_weights()
+            for travel in travels_batch:
+                links = batch_routes[travel.id_]
+                if len(links) > 0:
+                    yield Route(
+                        travel=travel,
+                        estimated_travel_time=Time(minutes=self.link_states.route_travel_time(links)),
+                        nodes=route_nodes(self.link_states, links),
+                    )
+
+    def assign_demand(
+            self,
+            demand: DemandMatrix,
+            clusters: List[Cluster],
+            road_graph: Optional[networkx.MultiDiGraph] = None,
+    ) -> List[ODRoute]:
+        """
+        Same incremental scheme as `assign_routes`, but each batch holds OD pairs instead of single travels
+        and every pair moves its whole trip count at once, so the work depends on the number of clusters only.
+        OD pairs without trips get no route.
+        """
+        self._initialize_graph(clusters, road_graph)
+        od_pairs = [od_pair for od_pair, trips in demand.trips.items() if trips > 0]
+
+        current_routes: Dict[ODPair, List[LinkId]] = {}
+        for iteration in range(self.iterations_count):
+            with self.instrumentation.stage("iteration", iteration=iteration):
+                for batch, od_pairs_batch in enumerate(batched(od_pairs, self.batch_size)):
+                    with self.instrumentation.stage("batch", iteration=iteration, batch=batch):
+                        paths = self._shortest_paths(od_pairs_batch)
+                        self._load_od_pairs(od_pairs_batch, paths, demand, current_routes)
+                        self._update_weights()
+
+        return [
+            ODRoute(
+                start=start,
+                end=end,
+                trips=demand.trips[(start, end)],
+                estimated_travel_time=Time(minutes=self.link_states.route_travel_time(current_route)),
+                nodes=route_nodes(self.link_states, current_route),
+            )
+            for (start, end), current_route in current_routes.items()
+            if len(current_route) > 0
+        ]
@@ -1,10 +1,15 @@
-import random
+from __future__ import annotations
+
 from dataclasses import dataclass, field
-from typing import List, Generator
+from typing import List, Generator, Dict, Iterator, Optional, Tuple
+
+import numpy as np
 
 from clusters import Cluster
 from my_types import ClusterId
-from population import PopulationGeneratorConfig
+from population import PopulationGeneratorConfig, Seed, child_seeds, seed_sequence
+
+ODPair = Tuple[ClusterId, ClusterId]
 
 
 def id_generator() -> Generator[int, None, None]:
@@ -22,24 +27,114 @@ class Travel:
     start: Cluster
     end: Cluster
     id_: int = field(default_factory=lambda: next(travel_id_generator))
+    time_slice: int = 0
+
+
+@dataclass
+class DemandMatrix:
+    clusters: List[Cluster]
+    trips: Dict[ODPair, int] = field(default_factory=dict)
+
+    @property
+    def total_trips(self) -> int:
+        return sum(self.trips.values())
+
+    def expand_travels(self, first_travel_id: int = 1) -> List[Travel]:
+        cluster_by_id = {cluster.h3_hex_id: cluster for cluster in self.clusters}
+        od_pairs = (od_pair for od_pair, count in self.trips.items() for _ in range(count))
+        return [
+            Travel(start=cluster_by_id[start], end=cluster_by_id[end], id_=travel_id)
+            for travel_id, (start, end) in enumerate(od_pairs, start=first_travel_id)
+        ]
+
+    @staticmethod
+    def from_travels(travels: List[Travel], clusters: List[Cluster]) -> DemandMatrix:
+        trips: Dict[ODPair, int] = {}
+        for travel in travels:
+            od_pair = (travel.start.h3_hex_id, travel.end.h3_hex_id)
+            trips[od_pair] = trips.get(od_pair, 0) + 1
+        return DemandMatrix(clusters=clusters, trips=trips)
 
 
 class TravelGenerator:
-    def __init__(self, config: PopulationGeneratorConfig) -> None:
+    """
+    Draws travels from every cluster to destinations weighted by cluster populations.
+
+    Each origin cluster draws from its own generator, seeded with a child of `seed`, and its travels get the ids
+    following those of all preceding clusters (starting at `first_travel_id`). Travels of any cluster can therefore
+    be generated independently, e.g. in another process, and a given seed always gives bit-identical travels.
+
+    With several `config.time_slices`, departure slices are drawn by slice shares from a separate generator, so
+    destinations are the same as without slices.
+    """
+
+    def __init__(self, config: PopulationGeneratorConfig, seed: Seed = None, first_travel_id: int = 1) -> None:
         self.config = config
+        self.seed = seed_sequence(seed)
+        self.first_travel_id = first_travel_id
+
+    def _travel_counts(self, clusters: List[Cluster]) -> np.ndarray:
+        return np.array(
+            [round(len(cluster.points) * self.config.travel_coefficient) for cluster in clusters], dtype=np.int64,
+        )
+
+    @staticmethod
+    def _destination_probabilities(clusters: List[Cluster]) -> np.ndarray:
+        weights = np.array([len(cluster.points) for cluster in clusters], dtype=np.float64)
+        return weights / weights.sum()
+
+    def _time_slice_probabilities(self) -> np.ndarray:
+        shares = np.array([time_slice.share for time_slice in self.config.time_slices], dtype=np.float64)
+        return shares / shares.sum()
 
     def generate_travels(self, clusters: List[Cluster]) -> List[Travel]:
-        travels = []
-        cluster_by_id = {cluster.h3_hex_id: cluster for cluster in clusters}
-        cluster_weights = {cluster.h3_hex_id: len(cluster.points) for cluster in clusters}
-        for cluster in clusters:
-            travel_destinations: List[ClusterId] = random.choices(
-                population=list(cluster_weights.keys()),
-                weights=list(cluster_weights.values()),
-                k=round(len(cluster.points) * self.config.travel_coefficient),
-            )
-            travels += [
-                Travel(start=cluster_by_id[cluster.h3_hex_id], end=cluster_by_id[destination])
-                for destination in travel_destinations
-            ]
-        return travels
+        return [travel for chunk in self.iter_travels(clusters) for travel in chunk]
+
+    def iter_travels(self, clusters: List[Cluster], chunk_size: Optional[int] = None) -> Iterator[List[Travel]]:
+        """
+        Yields the travels of `generate_travels` lazily, one chunk per origin cluster, or several chunks of at most
+        `chunk_size` travels for populous clusters. Chunking does not change the drawn destinations.
+        """
+        probabilities = self._destination_probabilities(clusters)
+        time_slice_probabilities = self._time_slice_probabilities()
+        travel_counts = self._travel_counts(clusters)
+        first_ids = self.first_travel_id + np.concatenate([[0], np.cumsum(travel_counts)[:-1]])
+        for cluster, rng_seed, travels_count, first_id in zip(
+                clusters, child_seeds(self.seed, len(clusters)), travel_counts.tolist(), first_ids.tolist(),
+        ):
+            rng = np.random.default_rng(rng_seed)
+            time_slice_rng = np.random.default_rng(child_seeds(rng_seed, 1)[0])
+            chunk_size_ = travels_count if chunk_size is None else chunk_size
+            for chunk_start in range(0, travels_count, max(chunk_size_, 1)):
+                size = min(chunk_size_, travels_count - chunk_start)
+                destinations = rng.choice(len(clusters), size=size, p=probabilities)
+                time_slices = (
+                    time_slice_rng.choice(len(time_slice_probabilities), size=size, p=time_slice_probabilities)
+                    if len(time_slice_probabilities) > 1 else np.zeros(size, dtype=np.int64)
+                )
+                yield [
+                    Travel(
+                        start=cluster,
+                        end=clusters[destination],
+                        id_=first_id + chunk_start + i,
+                        time_slice=time_slice,
+                    )
+                    for i, (destination, time_slice) in enumerate(zip(destinations.tolist(), time_slices.tolist()))
+                ]
+
+    def generate_demand_matrix(self, clusters: List[Cluster]) -> DemandMatrix:
+        """
+        Trip counts distributed like the travels of `generate_travels`, drawn as one multinomial sample per origin
+        from the origin's child seed. Counts are reproducible for a seed, but not equal to `generate_travels` counted
+        by OD pair, whose destinations are drawn one by one.
+        """
+        cluster_ids = [cluster.h3_hex_id for cluster in clusters]
+        probabilities = self._destination_probabilities(clusters)
+        trips: Dict[ODPair, int] = {}
+        for cluster, rng_seed, travels_count in zip(
+                clusters, child_seeds(self.seed, len(clusters)), self._travel_counts(clusters).tolist(),
+        ):
+            counts = np.random.default_rng(rng_seed).multinomial(travels_count, probabilities)
+            for destination_index in np.flatnonzero(counts):
+                trips[(cluster.h3_hex_id, cluster_ids[destination_index])] = int(counts[destination_index])
+        return DemandMatrix(clusters=clusters, trips=trips)
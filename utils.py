@@ -1,14 +1,23 @@
-from typing import List, Optional, Sequence, TypeVar, Generator
+from __future__ import annotations
+
+from itertools import accumulate, islice
+from typing import TYPE_CHECKING, Iterable, List, Optional, Sequence, Tuple, TypeVar, Generator
 
-import folium
 import h3
 import networkx
-import osmnx
-import osmnx.distance
+import numpy as np
 from networkx.classes.reportviews import NodeView
 
 from clusters import Cluster
-from distance import Coordinates
+from distance import Coordinates, PointSet
+from spatial import nearest_nodes, h3_cells
+
+# Drawing libraries (and osmnx, used only to draw routes) are imported by the functions that draw, so that
+# importing utils for `batched` or `chunked` stays cheap.
+if TYPE_CHECKING:
+    import folium
+
+GEOJSON_PRECISION = 6
 
 
 def visualize_paths(
@@ -17,6 +26,8 @@ def visualize_paths(
         paths: List[List[NodeView]],
         colors: Optional[str] = None,
 ) -> None:
+    import osmnx
+
     if colors is None:
         colors = ['blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen',
                   'cadetblue', 'darkpurple', 'white', 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
@@ -32,6 +43,8 @@ def visualize_weighted_paths(
         colors: List[str],
         weights: List[float],
 ) -> None:
+    import osmnx
+
     for i, path in enumerate(paths):
         osmnx.plot_route_folium(graph, path, route_map=map_, color=colors[i], weight=weights[i])
 
@@ -42,12 +55,16 @@ def visualize_paths_coordinates(
         paths: List[List[Coordinates]],
         colors: Optional[str] = None,
 ) -> None:
+    node_ids = nearest_nodes(
+        graph,
+        [cords.longitude for path in paths for cords in path],
+        [cords.latitude for path in paths for cords in path],
+    ).tolist()
+    path_ends = list(accumulate(len(path) for path in paths))
     visualize_paths(
         map_=map_,
         graph=graph,
-        paths=[
-            [osmnx.distance.nearest_nodes(graph, cords.longitude, cords.latitude) for cords in path] for path in paths
-        ],
+        paths=[node_ids[end - len(path):end] for path, end in zip(paths, path_ends)],
         colors=colors,
     )
 
@@ -57,6 +74,8 @@ def visualize_points(
         points: List[Coordinates],
         colors: Optional[str] = None,
 ) -> None:
+    import folium
+
     if colors is None:
         colors = ['blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen',
                   'cadetblue', 'darkpurple', 'white', 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
@@ -76,6 +95,8 @@ def visualize_clusters(
         clusters: List[Cluster],
         colors: Optional[str] = None,
 ) -> None:
+    import folium
+
     if colors is None:
         colors = ['blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen',
                   'cadetblue', 'darkpurple', 'white', 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
@@ -104,6 +125,164 @@ def visualize_clusters(
         map_.add_child(poly_line)
 
 
+def path_coordinates(graph: networkx.MultiDiGraph, path: List[NodeView]) -> List[Tuple[float, float]]:
+    """(longitude, latitude) pairs along `path`, following edge geometries when the graph has them"""
+    coordinates = [(graph.nodes[path[0]]['x'], graph.nodes[path[0]]['y'])]
+    for start, end in zip(path, path[1:]):
+        details = graph.get_edge_data(start, end)[0]
+        if 'geometry' in details:
+            coordinates += list(details['geometry'].coords)[1:]
+        else:
+            coordinates.append((graph.nodes[end]['x'], graph.nodes[end]['y']))
+    return [(round(x, GEOJSON_PRECISION), round(y, GEOJSON_PRECISION)) for x, y in coordinates]
+
+
+def visualize_weighted_paths_layer(
+        map_: folium.Map,
+        graph: networkx.MultiDiGraph,
+        paths: List[List[NodeView]],
+        colors: List[str],
+        weights: List[float],
+        tooltips: Optional[List[str]] = None,
+        name: str = "paths",
+) -> None:
+    """
+    Same picture as `visualize_weighted_paths`, drawn as a single GeoJSON layer: one line feature per path, with
+    equal styles shared between features, so the map stays compact for thousands of paths.
+    """
+    import folium
+
+    features = [
+        {
+            "type": "Feature",
+            "id": i,
+            "geometry": {"type": "LineString", "coordinates": path_coordinates(graph, path)},
+            "properties": {"color": colors[i], "weight": round(float(weights[i]), 2)},
+        }
+        for i, path in enumerate(paths)
+    ]
+    if tooltips is not None:
+        for feature, tooltip in zip(features, tooltips):
+            feature["properties"]["tooltip"] = tooltip
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name=name,
+        style_function=lambda feature: {
+            "color": feature["properties"]["color"],
+            "weight": feature["properties"]["weight"],
+            "opacity": 0.8,
+        },
+        tooltip=folium.GeoJsonTooltip(fields=["tooltip"], labels=False) if tooltips is not None else None,
+    ).add_to(map_)
+
+
+def _cell_counts(points: PointSet, resolution: int) -> Tuple[np.ndarray, np.ndarray]:
+    cells, counts = np.unique(h3_cells(points.latitudes, points.longitudes, resolution), return_counts=True)
+    return cells, counts
+
+
+def visualize_point_heatmap(
+        map_: folium.Map,
+        points: PointSet,
+        resolution: int = 10,
+        radius: int = 15,
+        name: str = "points",
+) -> None:
+    """
+    Heatmap of `points`, which are first counted per H3 cell at `resolution`; the map holds one sample per occupied
+    cell, weighted by its share of the largest count, instead of one marker per point.
+    """
+    import folium.plugins
+
+    cells, counts = _cell_counts(points, resolution)
+    intensities = counts / max(int(counts.max(initial=0)), 1)
+    samples = [
+        [*(round(degree, GEOJSON_PRECISION) for degree in h3.h3_to_geo(h3.h3_to_string(cell))), intensity]
+        for cell, intensity in zip(cells.tolist(), intensities.tolist())
+    ]
+    folium.plugins.HeatMap(samples, name=name, radius=radius).add_to(map_)
+
+
+def visualize_point_density(
+        map_: folium.Map,
+        points: PointSet,
+        resolution: int = 9,
+        colors: Sequence[str] = ("#ffffb2", "#fd8d3c", "#bd0026"),
+        name: str = "point density",
+) -> None:
+    """Number of `points` per H3 cell at `resolution`, drawn as a single layer of coloured hexagons"""
+    import branca.colormap
+    import folium
+
+    cells, counts = _cell_counts(points, resolution)
+    colormap = branca.colormap.LinearColormap(list(colors), vmin=0, vmax=max(int(counts.max(initial=0)), 1))
+    features = [
+        {
+            "type": "Feature",
+            "id": i,
+            "geometry": _cell_polygon(h3.h3_to_string(cell)),
+            "properties": {"count": count, "color": colormap(count)},
+        }
+        for i, (cell, count) in enumerate(zip(cells.tolist(), counts.tolist()))
+    ]
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name=name,
+        style_function=lambda feature: {
+            "fillColor": feature["properties"]["color"],
+            "fillOpacity": 0.6,
+            "weight": 0,
+        },
+        tooltip=folium.GeoJsonTooltip(fields=["count"]),
+    ).add_to(map_)
+
+
+def _cell_polygon(hexagon: str) -> dict:
+    boundary = [
+        [round(longitude, GEOJSON_PRECISION), round(latitude, GEOJSON_PRECISION)]
+        for longitude, latitude in h3.h3_to_geo_boundary(hexagon, geo_json=True)
+    ]
+    return {"type": "Polygon", "coordinates": [boundary]}
+
+
+def visualize_clusters_layer(
+        map_: folium.Map,
+        clusters: List[Cluster],
+        colors: Optional[str] = None,
+        name: str = "clusters",
+) -> None:
+    """Same outlines as `visualize_clusters`, drawn as a single GeoJSON layer with the population in tooltips"""
+    import folium
+
+    if colors is None:
+        colors = ['blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen',
+                  'cadetblue', 'darkpurple', 'white', 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
+    features = [
+        {
+            "type": "Feature",
+            "id": cluster.h3_hex_id,
+            "geometry": _cell_polygon(cluster.h3_hex_id),
+            "properties": {
+                "hexagon": cluster.h3_hex_id,
+                "population": len(cluster.points),
+                "color": colors[i % len(colors)],
+            },
+        }
+        for i, cluster in enumerate(clusters)
+    ]
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name=name,
+        style_function=lambda feature: {
+            "color": feature["properties"]["color"],
+            "weight": 1,
+            "fillOpacity": 0.1,
+        },
+        tooltip=folium.GeoJsonTooltip(fields=["population"], labels=False),
+        popup=folium.GeoJsonPopup(fields=["hexagon"], labels=False),
+    ).add_to(map_)
+
+
 _T = TypeVar("_T")
 
 
@@ -113,5 +292,14 @@ def batched(iterable: Sequence[_T], n=1) -> Generator[Sequence[_T], None, None]:
         yield iterable[ndx:min(ndx + n, iterable_length)]
 
 
+def chunked(iterable: Iterable[_T], n=1) -> Generator[List[_T], None, None]:
+    """Like `batched`, but for any iterable, of which only the current chunk is held in memory"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, n))
+
+
 def rescale(value: _T, old_max: _T, old_min: _T, new_max: _T, new_min: _T) -> _T:
     return (new_max - new_min) / (old_max - old_min) * (value - old_max) + new_max